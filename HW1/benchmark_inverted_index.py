@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import math
+import random
+import struct
+import timeit
+import time
+import platform
+import resource
+import cProfile
+import tracemalloc
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+from inverted_index import InvertedIndex, Tokenizer
+
+_MAX_LEGACY_DOC_ID = 65535
+_BYTES_IN_MEGABYTE = 1024 * 1024
+_KILOBYTE = 1024
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else _KILOBYTE
+_CLEAR_PEAK_RSS = '5'
+_TOP_ALLOCATIONS = 20
+_MILLISECONDS_IN_SECOND = 1000
+
+
+def generate_index(terms_count: int, docs_count: int, max_postings: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    return {f'term_{term_id}': set(rnd.sample(range(docs_count), rnd.randint(1, max_postings)))
+            for term_id in range(terms_count)}
+
+
+def encode_legacy_dict(conv_dict: dict) -> bytes:
+    bin_str = struct.pack('>i', len(conv_dict))
+    bin_str += b''.join([InvertedIndex.encode_string(key)
+                         + struct.pack('>H', len(docs_set))
+                         + b''.join([struct.pack('>H', doc_id) for doc_id in docs_set])
+                         for key, docs_set in conv_dict.items()
+                         ])
+    return bin_str
+
+
+def load_all_postings(bin_str: bytes):
+    for _ in InvertedIndex().decode_dict(bin_str).iter_items():
+        pass
+
+
+def run_load_benchmark(args):
+    if args.docs > _MAX_LEGACY_DOC_ID + 1:
+        raise ValueError(f'legacy format supports at most {_MAX_LEGACY_DOC_ID + 1} documents')
+    conv_dict = generate_index(args.terms, args.docs, args.max_postings, args.seed)
+    legacy_bin_str = encode_legacy_dict(conv_dict)
+    current_bin_str = InvertedIndex().encode_dict(conv_dict)
+
+    results = [
+        ('legacy', len(legacy_bin_str),
+         timeit.timeit(lambda: InvertedIndex().decode_dict(legacy_bin_str), number=args.repeat)),
+        ('current', len(current_bin_str),
+         timeit.timeit(lambda: load_all_postings(current_bin_str), number=args.repeat)),
+    ]
+    for name, size, total_time in results:
+        print(f'{name:>8}: {size:>10} bytes, load {total_time / args.repeat:.4f} s')
+    print(f'speedup: {results[0][2] / results[1][2]:.2f}x')
+
+
+def zipf_cum_weights(vocabulary_size: int, exponent: float) -> list:
+    return list(accumulate(1 / rank ** exponent for rank in range(1, vocabulary_size + 1)))
+
+
+def generate_corpus(path: str, docs_count: int, vocabulary_size: int, doc_length: int, exponent: float, seed: int):
+    """Write docs of Zipf distributed words, doc lengths are uniform in [1, 2 * doc_length]."""
+    rnd = random.Random(seed)
+    vocabulary = [f'w{word_ind}' for word_ind in range(vocabulary_size)]
+    cum_weights = zipf_cum_weights(vocabulary_size, exponent)
+    with open(path, 'w') as fd:
+        for doc_id in range(docs_count):
+            words = rnd.choices(vocabulary, cum_weights=cum_weights, k=rnd.randint(1, 2 * doc_length))
+            fd.write(f'{doc_id}\t{" ".join(words)}\n')
+
+
+def generate_queries(queries_count: int, vocabulary_size: int, query_length: int, exponent: float,
+                     seed: int) -> list:
+    rnd = random.Random(seed)
+    vocabulary = [f'w{word_ind}' for word_ind in range(vocabulary_size)]
+    cum_weights = zipf_cum_weights(vocabulary_size, exponent)
+    return [rnd.choices(vocabulary, cum_weights=cum_weights, k=rnd.randint(1, query_length))
+            for _ in range(queries_count)]
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+
+def reset_peak_rss() -> bool:
+    """Reset peak RSS of the process where Linux allows it, so the next peak is of a single stage."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write(_CLEAR_PEAK_RSS)
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> int:
+    """Peak RSS since the last reset_peak_rss, ru_maxrss of the whole process where it cant be reset."""
+    try:
+        with open('/proc/self/status', 'r') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * _KILOBYTE
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+class StageProfiler:
+    """Time pipeline stages, optionally under cProfile or tracemalloc, and collect stage results."""
+
+    def __init__(self, profile: str, profile_dir: str, name: str):
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.name = name
+        self.stages = {}
+
+    def run(self, stage: str, function, *args):
+        profiler = cProfile.Profile() if self.profile == 'cprofile' else None
+        if self.profile == 'tracemalloc':
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        rss_scope = 'stage' if reset_peak_rss() else 'process'
+        start_time = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start_time
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, f'{self.name}_{stage}.prof'))
+        # without reset the peak is cumulative over the stages run so far in the process
+        self.stages[stage] = {'seconds': elapsed, 'peak_rss_bytes': peak_rss(), 'peak_rss_scope': rss_scope}
+        if self.profile == 'tracemalloc':
+            self.stages[stage]['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            top_stats = tracemalloc.take_snapshot().statistics('lineno')[:_TOP_ALLOCATIONS]
+            tracemalloc.stop()
+            with open(os.path.join(self.profile_dir, f'{self.name}_{stage}.txt'), 'w') as fd:
+                fd.write('\n'.join(map(str, top_stats)) + '\n')
+        return result
+
+
+def run_queries(index: InvertedIndex, queries: list, top_k: int) -> list:
+    latencies = []
+    for words in queries:
+        start_time = time.perf_counter()
+        if top_k:
+            index.find_top_articles(words, top_k)
+        else:
+            index.find_articles(words)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def benchmark_size(args, docs_count: int) -> dict:
+    """Run build, dump, load and query stages over a generated corpus of docs_count docs."""
+    with tempfile.TemporaryDirectory(prefix='benchmark_inverted_index_') as work_dir:
+        corpus_path = os.path.join(work_dir, 'corpus.txt')
+        index_path = os.path.join(work_dir, 'corpus.index')
+        generate_corpus(corpus_path, docs_count, args.vocabulary, args.doc_length, args.zipf, args.seed)
+        queries = generate_queries(args.queries, args.vocabulary, args.query_length, args.zipf, args.seed + 1)
+        corpus_size = os.path.getsize(corpus_path)
+        profiler = StageProfiler(args.profile, args.profile_dir, f'docs_{docs_count}')
+
+        index = InvertedIndex(tokenizer=Tokenizer(), frequencies=bool(args.top_k))
+        with open(corpus_path, 'r') as fd:
+            profiler.run('build', index.build, fd, args.workers)
+        with open(index_path, 'wb') as fd:
+            profiler.run('dump', index.dump, fd)
+        index = InvertedIndex()
+        with open(index_path, 'rb') as fd:
+            profiler.run('load', index.load, fd)
+        latencies = sorted(profiler.run('query', run_queries, index, queries, args.top_k))
+        index_size = os.path.getsize(index_path)
+
+    stages = profiler.stages
+    stages['build']['docs_per_second'] = docs_count / stages['build']['seconds']
+    stages['build']['megabytes_per_second'] = corpus_size / _BYTES_IN_MEGABYTE / stages['build']['seconds']
+    stages['query']['queries_per_second'] = len(queries) / stages['query']['seconds']
+    stages['query']['p50_ms'] = percentile(latencies, 50) * _MILLISECONDS_IN_SECOND
+    stages['query']['p99_ms'] = percentile(latencies, 99) * _MILLISECONDS_IN_SECOND
+    return {
+        'docs': docs_count,
+        'corpus_bytes': corpus_size,
+        'index_bytes': index_size,
+        'stages': stages,
+    }
+
+
+def run_pipeline_benchmark(args):
+    if args.profile and not args.profile_dir:
+        raise ValueError('--profile-dir is required with --profile')
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+    results = []
+    for docs_count in args.sizes:
+        # every size runs in a fresh process, so peak RSS is not inherited from smaller sizes
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(benchmark_size, args, docs_count).result())
+        stages = results[-1]['stages']
+        print(f'{docs_count:>9} docs: build {stages["build"]["docs_per_second"]:.0f} docs/s, '
+              f'dump {stages["dump"]["seconds"]:.3f} s, load {stages["load"]["seconds"]:.3f} s, '
+              f'query {stages["query"]["queries_per_second"]:.0f} q/s p50 {stages["query"]["p50_ms"]:.3f} ms '
+              f'p99 {stages["query"]["p99_ms"]:.3f} ms, peak rss ({stages["build"]["peak_rss_scope"]}) build '
+              f'{stages["build"]["peak_rss_bytes"] / _BYTES_IN_MEGABYTE:.1f} MB, query '
+              f'{stages["query"]["peak_rss_bytes"] / _BYTES_IN_MEGABYTE:.1f} MB', file=sys.stderr)
+    report = {
+        'label': args.label,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'handler'},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + '\n')
+    else:
+        print(output)
+
+
+def setup_parser(arg_parser):
+    sub_parsers = arg_parser.add_subparsers(help='choose benchmark')
+    load_parser = sub_parsers.add_parser(
+        'load',
+        help='compare load time of legacy and current inverted index formats',
+    )
+    load_parser.add_argument('--terms', help='number of terms in index', type=int, default=20000)
+    load_parser.add_argument('--docs', help='number of documents in index', type=int, default=60000)
+    load_parser.add_argument('--max-postings', help='max postings per term', type=int, default=200)
+    load_parser.add_argument('--repeat', help='number of loads to average', type=int, default=3)
+    load_parser.add_argument('--seed', help='random seed for generated index', type=int, default=0)
+    load_parser.set_defaults(handler=run_load_benchmark)
+    pipeline_parser = sub_parsers.add_parser(
+        'pipeline',
+        help='time build, dump, load and query of generated Zipf corpora and report them as json',
+    )
+    pipeline_parser.add_argument('--sizes', help='numbers of documents in generated corpora', type=int, nargs='+',
+                                 default=[1000, 10000, 100000])
+    pipeline_parser.add_argument('--vocabulary', help='number of distinct words', type=int, default=50000)
+    pipeline_parser.add_argument('--doc-length', help='mean number of words in document', type=int, default=100)
+    pipeline_parser.add_argument('--zipf', help='exponent of Zipf distribution of words', type=float, default=1.0)
+    pipeline_parser.add_argument('--queries', help='number of queries', type=int, default=1000)
+    pipeline_parser.add_argument('--query-length', help='max number of words in query', type=int, default=3)
+    pipeline_parser.add_argument('--top-k', help='run ranked top-k queries over index with frequencies',
+                                 type=int, default=0)
+    pipeline_parser.add_argument('--workers', help='number of processes building index', type=int, default=1)
+    pipeline_parser.add_argument('--seed', help='random seed for generated corpora', type=int, default=0)
+    pipeline_parser.add_argument('--profile', help='profile every stage', choices=['cprofile', 'tracemalloc'])
+    pipeline_parser.add_argument('--profile-dir', help='directory for .prof and allocation files of stages')
+    pipeline_parser.add_argument('--label', help='name of the run stored in report, e.g. commit', default='')
+    pipeline_parser.add_argument('-o', '--output', help='path of json report, printed to stdout if not set')
+    pipeline_parser.set_defaults(handler=run_pipeline_benchmark)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        prog='benchmark_inverted_index',
+        description='benchmarks of inverted index formats and pipeline',
+    )
+    setup_parser(parser)
+    arguments = parser.parse_args()
+    if not hasattr(arguments, 'handler'):
+        parser.print_help()
+        sys.exit(1)
+    arguments.handler(arguments)
@@ -1,7 +1,24 @@
+import os
+import re
 import sys
-from io import TextIOWrapper
-from collections import defaultdict
-from typing import Tuple, List, TextIO, BinaryIO, DefaultDict
+import glob
+import time
+import asyncio
+import threading
+import mmap
+import heapq
+import operator
+import math
+import string
+import tempfile
+from array import array
+from bisect import bisect_left, insort
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import TextIOWrapper, BytesIO, BufferedWriter, RawIOBase
+from itertools import accumulate, chain, groupby, islice
+from collections import defaultdict, Counter, OrderedDict
+from collections.abc import Mapping
+from typing import Tuple, List, TextIO, BinaryIO, DefaultDict, Optional, Iterator, Dict, Iterable, Set, NamedTuple
 
 import struct
 from argparse import ArgumentParser, FileType, ArgumentTypeError, Namespace
@@ -9,6 +26,44 @@ from argparse import ArgumentParser, FileType, ArgumentTypeError, Namespace
 _U_CHAR_SIZE = 1
 _U_SHORT_SIZE = 2
 _INT_SIZE = 4
+_U_LONG_LONG_SIZE = 8
+
+_INDEX_MAGIC = b'INVX'
+_INDEX_VERSION = 5
+_SHORT_POSTINGS_VERSION = 1
+_VARINT_POSTINGS_VERSION = 2
+_FLAGS_VERSION = 4
+_SUPPORTED_VERSIONS = (1, 2, 3, 4, 5)
+_TERMS_PER_BLOCK = 16
+_PREFIX_WILDCARD = '*'
+_VARINT_DATA_MASK = 0x7f
+_VARINT_NEXT_BIT = 0x80
+_MAX_DOC_ID_VARINT_SIZE = 5
+_DOC_ID_TYPECODE = 'I'
+_MAX_DOC_ID = 2 ** 32 - 1
+_GAP_TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+_BUILD_CHUNK_SIZE = 64 * 1024 * 1024
+_BYTES_IN_MEGABYTE = 1024 * 1024
+_TERM_MEMORY_COST = 300
+_POSTING_MEMORY_COST = 8
+_MILLISECONDS_IN_SECOND = 1000
+_QUERY_BATCH_SIZE = 10000
+_SEGMENT_SUFFIX = '.seg'
+_COMPACT_SUFFIX = '.compact'
+_COMPACTION_MANIFEST_SUFFIX = '.compacting'
+_MAX_SEGMENTS = 10
+_MAGIC_FORMAT = '>4sB'
+_MAGIC_SIZE = struct.calcsize(_MAGIC_FORMAT)
+_HEADER_FORMAT = '>4sBB'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_LOWERCASE_FLAG = 0x1
+_STRIP_PUNCTUATION_FLAG = 0x2
+_FREQUENCIES_FLAG = 0x4
+_PUNCTUATION = string.punctuation + '«»„“”‘’–—…'
+_FOOTER_FORMAT = '>IQ'
+_FOOTER_SIZE = struct.calcsize(_FOOTER_FORMAT)
+_BM25_K1 = 1.2
+_BM25_B = 0.75
 
 
 class EncodedFileType(FileType):
@@ -33,26 +88,939 @@ class EncodedFileType(FileType):
             raise ArgumentTypeError(message % (string, e))
 
 
+def encode_varint(value: int) -> bytes:
+    if value < 0:
+        raise ValueError(f'varint must be non-negative, got {value}')
+    bin_str = bytearray()
+    while value > _VARINT_DATA_MASK:
+        bin_str.append(value & _VARINT_DATA_MASK | _VARINT_NEXT_BIT)
+        value >>= 7
+    bin_str.append(value)
+    return bytes(bin_str)
+
+
+def decode_varint(bin_str: bytes, start_ind: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    read_ind = start_ind
+    while True:
+        byte = bin_str[read_ind]
+        read_ind += 1
+        value |= (byte & _VARINT_DATA_MASK) << shift
+        if not byte & _VARINT_NEXT_BIT:
+            return value, read_ind - start_ind
+        shift += 7
+
+
+def decode_varints(bin_str: bytes, start_ind: int, count: int) -> Tuple[array, int]:
+    block = bin_str[start_ind:start_ind + count]
+    if len(block) == count and (count == 0 or max(block) <= _VARINT_DATA_MASK):
+        return array(_DOC_ID_TYPECODE, array('B', block)), count
+    block = bin_str[start_ind:start_ind + count * _MAX_DOC_ID_VARINT_SIZE]
+    values = array(_DOC_ID_TYPECODE)
+    value = 0
+    shift = 0
+    read_bytes = 0
+    for byte in block:
+        read_bytes += 1
+        value |= (byte & _VARINT_DATA_MASK) << shift
+        if byte & _VARINT_NEXT_BIT:
+            shift += 7
+            continue
+        values.append(value)
+        if len(values) == count:
+            break
+        value = 0
+        shift = 0
+    return values, read_bytes
+
+
+def decode_packed(bin_str: bytes, start_ind: int, count: int, typecode: str) -> array:
+    values = array(typecode)
+    values.frombytes(bin_str[start_ind:start_ind + count * values.itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def value_width(max_value: int) -> int:
+    return next(width for width in _GAP_TYPECODES if max_value < 1 << 8 * width)
+
+
+def pack_width(values: Iterable[int], width: int) -> bytes:
+    packed_values = array(_GAP_TYPECODES[width], values)
+    if sys.byteorder == 'little':
+        packed_values.byteswap()
+    return packed_values.tobytes()
+
+
+def pack_values(values: Iterable[int]) -> bytes:
+    values = values if isinstance(values, array) else array(_DOC_ID_TYPECODE, values)
+    width = value_width(max(values, default=0))
+    return struct.pack('>B', width) + pack_width(values, width)
+
+
+def doc_gaps(docs: array, prev_doc_id: int = 0) -> array:
+    return array(_DOC_ID_TYPECODE, map(operator.sub, docs, chain((prev_doc_id,), docs)))
+
+
+def unpack_values(bin_str: bytes, start_ind: int, count: int) -> Tuple[array, int]:
+    width = bin_str[start_ind]
+    return decode_packed(bin_str, start_ind + _U_CHAR_SIZE, count, _GAP_TYPECODES[width]), _U_CHAR_SIZE + count * width
+
+
+def gallop_search(postings: array, doc_id: int, low: int) -> int:
+    step = 1
+    high = low
+    while high < len(postings) and postings[high] < doc_id:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(postings, doc_id, low, min(high, len(postings)))
+
+
+def intersect_postings(short_postings: array, long_postings: array) -> array:
+    output = array(_DOC_ID_TYPECODE)
+    read_ind = 0
+    for doc_id in short_postings:
+        read_ind = gallop_search(long_postings, doc_id, read_ind)
+        if read_ind == len(long_postings):
+            break
+        if long_postings[read_ind] == doc_id:
+            output.append(doc_id)
+            read_ind += 1
+    return output
+
+
+def union_postings(words_postings: List[array]) -> array:
+    """Union of sorted postings, postings over increasing doc ranges are concatenated without merging."""
+    words_postings = [postings for postings in words_postings if len(postings)]
+    if len(words_postings) == 1:
+        return words_postings[0]
+    if all(prev_postings[-1] < postings[0] for prev_postings, postings in zip(words_postings, words_postings[1:])):
+        docs = array(_DOC_ID_TYPECODE)
+        for postings in words_postings:
+            docs.extend(postings)
+        return docs
+    return array(_DOC_ID_TYPECODE, (doc_id for doc_id, _ in groupby(heapq.merge(*words_postings))))
+
+
+def merge_scored_postings(words_postings: List[Tuple[Iterable[int], Iterable[int]]]) -> Tuple[array, array]:
+    """Merge postings with frequencies, frequencies of a doc found in several postings are summed."""
+    if len(words_postings) == 1:
+        return words_postings[0]
+    doc_frequencies = defaultdict(int)
+    for docs, frequencies in words_postings:
+        for doc_id, frequency in zip(docs, frequencies):
+            doc_frequencies[doc_id] += frequency
+    docs = sorted(doc_frequencies)
+    return array(_DOC_ID_TYPECODE, docs), array(_DOC_ID_TYPECODE, (doc_frequencies[doc_id] for doc_id in docs))
+
+
+def merge_bounded_postings(words_postings: List['ScoredPostings']) -> 'ScoredPostings':
+    """Merge postings with frequencies and bounds of runs over increasing doc ranges by concatenation.
+
+    Overlapping runs are merged by merge_scored_postings, min doc length of their
+    merge stays a lower bound as lengths of a doc found in several runs are summed.
+    """
+    if len(words_postings) == 1:
+        return words_postings[0]
+    min_doc_length = min(postings.min_doc_length for postings in words_postings)
+    if all(prev_postings.docs[-1] < postings.docs[0]
+           for prev_postings, postings in zip(words_postings, words_postings[1:])):
+        docs = array(_DOC_ID_TYPECODE)
+        frequencies = array(_DOC_ID_TYPECODE)
+        for postings in words_postings:
+            docs.extend(postings.docs)
+            frequencies.extend(iter(postings.frequencies))
+        return ScoredPostings(docs, frequencies, max(postings.max_frequency for postings in words_postings),
+                              min_doc_length)
+    docs, frequencies = merge_scored_postings([(postings.docs, postings.frequencies) for postings in words_postings])
+    return ScoredPostings(docs, frequencies, max(frequencies), min_doc_length)
+
+
+def bm25_idf(docs_count: int, postings_count: int) -> float:
+    return math.log(1 + (docs_count - postings_count + 0.5) / (postings_count + 0.5))
+
+
+def bm25_term_score(idf: float, frequency: int, doc_length: int, avg_doc_length: float) -> float:
+    return idf * frequency * (_BM25_K1 + 1) / (
+        frequency + _BM25_K1 * (1 - _BM25_B + _BM25_B * doc_length / avg_doc_length))
+
+
+def max_score_top_k(terms_postings: List['ScoredPostings'], doc_lengths: Mapping, avg_doc_length: float,
+                    top_k: int) -> List[Tuple[int, float]]:
+    """Top k docs by BM25 with MaxScore early termination, ties are broken by smaller doc_id.
+
+    Postings are ordered by score upper bound. Postings whose bounds sum can not beat
+    the current k-th score are non-essential: they never produce candidates and are
+    only probed by galloping search for candidates of essential postings, probing
+    stops as soon as the candidate can not enter the top.
+    """
+    if top_k <= 0 or len(doc_lengths) == 0:
+        return []
+    bounded_postings = sorted(
+        ((bm25_term_score(idf, postings.max_frequency, postings.min_doc_length, avg_doc_length), idf, postings)
+         for idf, postings in ((bm25_idf(len(doc_lengths), len(postings.docs)), postings)
+                               for postings in terms_postings)),
+        key=operator.itemgetter(0))
+    bounds_sums = list(accumulate(bound for bound, _, _ in bounded_postings))
+    idfs = [idf for _, idf, _ in bounded_postings]
+    docs = [postings.docs for _, _, postings in bounded_postings]
+    frequencies = [postings.frequencies for _, _, postings in bounded_postings]
+    cursors = [0] * len(docs)
+    top = []
+    threshold = -math.inf
+    first_essential = 0
+    while True:
+        while first_essential < len(docs) and bounds_sums[first_essential] <= threshold:
+            first_essential += 1
+        doc_id = min((docs[ind][cursors[ind]] for ind in range(first_essential, len(docs))
+                      if cursors[ind] < len(docs[ind])), default=None)
+        if doc_id is None:
+            break
+        length_norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * doc_lengths[doc_id] / avg_doc_length)
+        score = 0.0
+        for ind in range(first_essential, len(docs)):
+            cursor = cursors[ind]
+            if cursor < len(docs[ind]) and docs[ind][cursor] == doc_id:
+                frequency = frequencies[ind][cursor]
+                score += idfs[ind] * frequency * (_BM25_K1 + 1) / (frequency + length_norm)
+                cursors[ind] = cursor + 1
+        for ind in range(first_essential - 1, -1, -1):
+            if score + bounds_sums[ind] <= threshold:
+                break
+            cursor = gallop_search(docs[ind], doc_id, cursors[ind])
+            cursors[ind] = cursor
+            if cursor < len(docs[ind]) and docs[ind][cursor] == doc_id:
+                frequency = frequencies[ind][cursor]
+                score += idfs[ind] * frequency * (_BM25_K1 + 1) / (frequency + length_norm)
+        candidate = (score, -doc_id)
+        if len(top) < top_k:
+            heapq.heappush(top, candidate)
+        elif candidate > top[0]:
+            heapq.heapreplace(top, candidate)
+        if len(top) == top_k:
+            threshold = top[0][0]
+    return [(-neg_doc_id, score) for score, neg_doc_id in sorted(top, reverse=True)]
+
+
+def split_file_chunks(path: str, chunks_count: int) -> List[Tuple[int, int]]:
+    file_size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as fd:
+        for chunk_ind in range(1, chunks_count):
+            fd.seek(max(file_size * chunk_ind // chunks_count, bounds[-1]))
+            fd.readline()
+            bounds.append(fd.tell())
+    bounds.append(file_size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def build_chunk(path: str, start: int, end: int, encoding: str, tokenizer: 'Tokenizer',
+                frequencies: bool = False) -> 'TermPostings':
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        chunk = fd.read(end - start)
+    index = InvertedIndex(tokenizer=tokenizer, frequencies=frequencies)
+    index.build(TextIOWrapper(BytesIO(chunk), encoding=encoding))
+    return index.inverted_index
+
+
+class Tokenizer:
+    """Split document into unique terms, optionally lowercased and stripped of punctuation."""
+
+    def __init__(self, lowercase: bool = False, strip_punctuation: bool = False):
+        self.lowercase = lowercase
+        self.strip_punctuation = strip_punctuation
+
+    @classmethod
+    def from_flags(cls, flags: int) -> 'Tokenizer':
+        return cls(lowercase=bool(flags & _LOWERCASE_FLAG), strip_punctuation=bool(flags & _STRIP_PUNCTUATION_FLAG))
+
+    @property
+    def flags(self) -> int:
+        return (_LOWERCASE_FLAG if self.lowercase else 0) | (_STRIP_PUNCTUATION_FLAG if self.strip_punctuation else 0)
+
+    def tokenize_words(self, words: Iterable[str]) -> Set[str]:
+        terms = set(words)
+        if self.lowercase:
+            terms = {term.lower() for term in terms}
+        if self.strip_punctuation:
+            terms = {term.strip(_PUNCTUATION) for term in terms}
+            terms.discard('')
+        return terms
+
+    def tokenize(self, content: str) -> Set[str]:
+        return self.tokenize_words(content.split())
+
+    def normalize(self, word: str) -> str:
+        if self.lowercase:
+            word = word.lower()
+        if self.strip_punctuation:
+            word = word.strip(_PUNCTUATION)
+        return word
+
+    def count_terms(self, content: str) -> Dict[str, int]:
+        words_counts = Counter(content.split())
+        if not self.lowercase and not self.strip_punctuation:
+            return words_counts
+        terms_counts = Counter()
+        for word, count in words_counts.items():
+            term = self.normalize(word)
+            if term:
+                terms_counts[term] += count
+        return terms_counts
+
+    def tokenize_query(self, words: Iterable[str]) -> Set[str]:
+        words = set(words)
+        prefixes = {word for word in words if is_prefix_pattern(word)}
+        terms = self.tokenize_words(words - prefixes)
+        terms.update(prefix + _PREFIX_WILDCARD for prefix in self.tokenize_words(word[:-1] for word in prefixes))
+        return terms
+
+
+class ScoredPostings(NamedTuple):
+    """Sorted doc ids with term frequencies and bounds used to limit the term score."""
+    docs: array
+    frequencies: array
+    max_frequency: int
+    min_doc_length: int
+
+
+class DocLengths(Mapping):
+    """Lengths of documents kept as sorted doc ids and aligned lengths arrays."""
+
+    def __init__(self, doc_ids: array, lengths: array):
+        self.doc_ids = doc_ids
+        self.lengths = lengths
+        self.total_length = sum(lengths)
+
+    def __getitem__(self, doc_id: int) -> int:
+        ind = bisect_left(self.doc_ids, doc_id)
+        if ind == len(self.doc_ids) or self.doc_ids[ind] != doc_id:
+            raise KeyError(doc_id)
+        return self.lengths[ind]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.doc_ids)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+
+class RunsDocLengths:
+    """Lengths of documents of index runs over increasing doc ranges, encoded run by run.
+
+    Only one run's lengths are decoded at a time, widths of packed gaps and
+    lengths are found by a first pass over the runs.
+    """
+
+    def __init__(self, runs: List['MappedIndex']):
+        self.runs = runs
+
+    def iter_runs(self) -> Iterator[DocLengths]:
+        for run in self.runs:
+            yield run.read_doc_lengths()
+
+    def encode(self) -> Iterator[bytes]:
+        docs_count = max_gap = max_length = prev_doc_id = 0
+        for run_lengths in self.iter_runs():
+            if len(run_lengths):
+                docs_count += len(run_lengths)
+                max_gap = max(max_gap, max(doc_gaps(run_lengths.doc_ids, prev_doc_id)))
+                max_length = max(max_length, max(run_lengths.lengths))
+                prev_doc_id = run_lengths.doc_ids[-1]
+        gap_width = value_width(max_gap)
+        yield encode_varint(docs_count) + struct.pack('>B', gap_width)
+        prev_doc_id = 0
+        for run_lengths in self.iter_runs():
+            if len(run_lengths):
+                yield pack_width(doc_gaps(run_lengths.doc_ids, prev_doc_id), gap_width)
+                prev_doc_id = run_lengths.doc_ids[-1]
+        length_width = value_width(max_length)
+        yield struct.pack('>B', length_width)
+        for run_lengths in self.iter_runs():
+            yield pack_width(run_lengths.lengths, length_width)
+
+
+class TermPostings(Mapping):
+    """Build-time index, terms are interned to dense ids and postings are kept as sorted arrays by term id.
+
+    With frequencies, term frequencies are kept in arrays aligned with postings
+    and lengths of documents in doc_lengths.
+    """
+
+    def __init__(self, frequencies: bool = False):
+        self.term_ids = {}
+        self.terms = []
+        self.postings = []
+        self.frequencies = [] if frequencies else None
+        self.doc_lengths = {}
+        self.total_doc_length = 0
+
+    def term_id(self, term: str) -> int:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = len(self.terms)
+            self.term_ids[term] = term_id
+            self.terms.append(term)
+            self.postings.append(array(_DOC_ID_TYPECODE))
+            if self.frequencies is not None:
+                self.frequencies.append(array(_DOC_ID_TYPECODE))
+        return term_id
+
+    def add(self, term: str, doc_id: int):
+        self.add_document(doc_id, (term,))
+
+    def add_document(self, doc_id: int, terms: Iterable[str]):
+        if self.frequencies is not None:
+            self.add_counts(doc_id, terms if isinstance(terms, Mapping) else Counter(terms))
+            return
+        term_ids = self.term_ids
+        terms_postings = self.postings
+        for term in terms:
+            term_id = term_ids.get(term)
+            if term_id is None:
+                term_id = self.term_id(term)
+            postings = terms_postings[term_id]
+            if not postings or postings[-1] < doc_id:
+                postings.append(doc_id)
+            elif postings[bisect_left(postings, doc_id)] != doc_id:
+                insort(postings, doc_id)
+
+    def add_counts(self, doc_id: int, terms_counts: Mapping):
+        self.add_doc_length(doc_id, sum(terms_counts.values()))
+        for term, count in terms_counts.items():
+            self.add_frequency(term, doc_id, count)
+
+    def add_doc_length(self, doc_id: int, length: int):
+        self.doc_lengths[doc_id] = self.doc_lengths.get(doc_id, 0) + length
+        self.total_doc_length += length
+
+    def add_frequency(self, term: str, doc_id: int, count: int):
+        term_id = self.term_id(term)
+        postings = self.postings[term_id]
+        frequencies = self.frequencies[term_id]
+        insert_ind = len(postings) if not postings or postings[-1] < doc_id else bisect_left(postings, doc_id)
+        if insert_ind < len(postings) and postings[insert_ind] == doc_id:
+            frequencies[insert_ind] += count
+        else:
+            postings.insert(insert_ind, doc_id)
+            frequencies.insert(insert_ind, count)
+
+    def merge(self, other: 'TermPostings'):
+        for term_id, term in enumerate(other.terms):
+            if self.frequencies is None:
+                self.update(term, other.postings[term_id])
+                continue
+            docs = other.postings[term_id]
+            self_term_id = self.term_id(term)
+            postings = self.postings[self_term_id]
+            if docs and (not postings or postings[-1] < docs[0]):
+                postings.extend(docs)
+                self.frequencies[self_term_id].extend(other.frequencies[term_id])
+                continue
+            for doc_id, count in zip(docs, other.frequencies[term_id]):
+                self.add_frequency(term, doc_id, count)
+        for doc_id, length in other.doc_lengths.items():
+            self.add_doc_length(doc_id, length)
+
+    def scored_postings(self, term: str) -> Optional[ScoredPostings]:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return None
+        docs = self.postings[term_id]
+        frequencies = self.frequencies[term_id]
+        return ScoredPostings(docs, frequencies, max(frequencies),
+                              min(self.doc_lengths[doc_id] for doc_id in docs))
+
+    def iter_scored_items(self) -> Iterator[Tuple[str, Tuple[array, array]]]:
+        for term in sorted(self.term_ids):
+            term_id = self.term_ids[term]
+            yield term, (self.postings[term_id], self.frequencies[term_id])
+
+    def update(self, term: str, docs: Iterable[int]):
+        """Add docs to term postings, arrays are taken as sorted and appended at once past the last doc."""
+        postings = self.postings[self.term_id(term)]
+        if isinstance(docs, array) and docs and (not postings or postings[-1] < docs[0]):
+            postings.extend(docs)
+            return
+        for doc_id in docs:
+            if len(postings) == 0 or postings[-1] < doc_id:
+                postings.append(doc_id)
+            elif postings[bisect_left(postings, doc_id)] != doc_id:
+                insort(postings, doc_id)
+
+    def __getitem__(self, term: str) -> array:
+        return self.postings[self.term_ids[term]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.term_ids)
+
+    def __len__(self) -> int:
+        return len(self.term_ids)
+
+
+class MappedIndex(Mapping):
+    """Read-only index over a dumped binary string, postings are decoded into arrays on lookup.
+
+    Layout: header, blocks of up to 16 terms, block offset table with one
+    '>Q' offset per block and footer with terms count and table offset.
+    A block is the postings of its terms followed by the front-coded terms:
+    varint shared prefix length with the previous term, varint suffix length,
+    suffix and varint gap to the previous term postings offset. The block of
+    a term is found by bisection over first terms of blocks, kept in memory as
+    a sparse index when bisection first visits them.
+    Entry postings are a varint count, gap width byte and big-endian gaps
+    between sorted doc ids packed with that width. Version 2 files keep gaps
+    as varints, version 1 files keep '>H' count and doc ids.
+
+    Index with frequencies flag prefixes entry postings with varint max term
+    frequency and varint min length of its docs and follows them with width
+    byte and packed frequencies. Lengths of all docs are stored after block
+    table as doc ids postings and packed lengths, with '>Q' offset before footer.
+    """
+
+    def __init__(self, bin_str: bytes):
+        magic, version = struct.unpack_from(_MAGIC_FORMAT, bin_str, 0)
+        if magic != _INDEX_MAGIC:
+            raise ValueError('binary string is not an inverted index')
+        if version not in _SUPPORTED_VERSIONS:
+            raise ValueError(f'unsupported inverted index version {version}')
+        self._bin_str = bin_str
+        self._version = version
+        self.flags = bin_str[_MAGIC_SIZE] if version >= _FLAGS_VERSION else 0
+        self._size, self._table_offset = struct.unpack_from(_FOOTER_FORMAT, bin_str, len(bin_str) - _FOOTER_SIZE)
+        self._doc_lengths = None
+        self._block_heads = {}
+
+    def _block_offset(self, block_ind: int) -> int:
+        return struct.unpack_from('>Q', self._bin_str, self._table_offset + block_ind * _U_LONG_LONG_SIZE)[0]
+
+    def _read_block(self, block_ind: int) -> Iterator[Tuple[bytes, int]]:
+        read_ind = self._block_offset(block_ind)
+        term = b''
+        postings_ind = 0
+        for _ in range(min(_TERMS_PER_BLOCK, self._size - block_ind * _TERMS_PER_BLOCK)):
+            shared_len, read_bytes = decode_varint(self._bin_str, read_ind)
+            read_ind += read_bytes
+            suffix_len, read_bytes = decode_varint(self._bin_str, read_ind)
+            read_ind += read_bytes
+            term = term[:shared_len] + self._bin_str[read_ind:read_ind + suffix_len]
+            read_ind += suffix_len
+            postings_gap, read_bytes = decode_varint(self._bin_str, read_ind)
+            read_ind += read_bytes
+            postings_ind += postings_gap
+            yield term, postings_ind
+
+    def _block_head(self, block_ind: int) -> bytes:
+        head = self._block_heads.get(block_ind)
+        if head is None:
+            head = self._block_heads[block_ind] = next(self._read_block(block_ind))[0]
+        return head
+
+    def _iter_entries_from(self, key: bytes) -> Iterator[Tuple[bytes, int]]:
+        blocks_count = -(-self._size // _TERMS_PER_BLOCK)
+        # bisection of blocks decodes only heads of visited blocks, the sparse index of heads grows with lookups
+        low, high = 0, blocks_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        for block_ind in range(max(low - 1, 0), blocks_count):
+            for term, postings_ind in self._read_block(block_ind):
+                if term >= key:
+                    yield term, postings_ind
+
+    def _find_postings(self, word: str) -> Optional[int]:
+        key = word.encode()
+        for term, postings_ind in self._iter_entries_from(key):
+            return postings_ind if term == key else None
+        return None
+
+    def _read_postings(self, read_ind: int) -> array:
+        if self._version == _SHORT_POSTINGS_VERSION:
+            set_size = struct.unpack_from('>H', self._bin_str, read_ind)[0]
+            return array(_DOC_ID_TYPECODE, decode_packed(self._bin_str, read_ind + _U_SHORT_SIZE, set_size, 'H'))
+        if self._version == _VARINT_POSTINGS_VERSION:
+            set_size, read_bytes = decode_varint(self._bin_str, read_ind)
+            doc_gaps = decode_varints(self._bin_str, read_ind + read_bytes, set_size)[0]
+            return array(_DOC_ID_TYPECODE, accumulate(doc_gaps))
+        if self.flags & _FREQUENCIES_FLAG:
+            for _ in range(2):
+                read_ind += decode_varint(self._bin_str, read_ind)[1]
+        return InvertedIndex.decode_postings(self._bin_str, read_ind)[0]
+
+    @property
+    def doc_lengths(self) -> DocLengths:
+        if not self.flags & _FREQUENCIES_FLAG:
+            raise ValueError('inverted index has no term frequencies')
+        if self._doc_lengths is None:
+            self._doc_lengths = self.read_doc_lengths()
+        return self._doc_lengths
+
+    def read_doc_lengths(self) -> DocLengths:
+        """Decode lengths of docs without keeping them in the index."""
+        if not self.flags & _FREQUENCIES_FLAG:
+            raise ValueError('inverted index has no term frequencies')
+        offset_ind = len(self._bin_str) - _FOOTER_SIZE - _U_LONG_LONG_SIZE
+        read_ind = struct.unpack_from('>Q', self._bin_str, offset_ind)[0]
+        doc_ids, read_bytes = InvertedIndex.decode_postings(self._bin_str, read_ind)
+        return DocLengths(doc_ids, unpack_values(self._bin_str, read_ind + read_bytes, len(doc_ids))[0])
+
+    @property
+    def total_doc_length(self) -> int:
+        return self.doc_lengths.total_length
+
+    def scored_postings(self, word: str) -> Optional[ScoredPostings]:
+        if not self.flags & _FREQUENCIES_FLAG:
+            raise ValueError('inverted index has no term frequencies')
+        postings_ind = self._find_postings(word)
+        if postings_ind is None:
+            return None
+        return InvertedIndex.decode_scored_postings(self._bin_str, postings_ind)[0]
+
+    def iter_scored_items(self) -> Iterator[Tuple[str, Tuple[array, array]]]:
+        for term, postings in self.iter_scored_postings():
+            yield term, (postings.docs, postings.frequencies)
+
+    def iter_scored_postings(self) -> Iterator[Tuple[str, ScoredPostings]]:
+        for term, postings_ind in self._iter_entries_from(b''):
+            yield term.decode(), InvertedIndex.decode_scored_postings(self._bin_str, postings_ind)[0]
+
+    def iter_items(self) -> Iterator[Tuple[str, array]]:
+        for term, postings_ind in self._iter_entries_from(b''):
+            yield term.decode(), self._read_postings(postings_ind)
+
+    def iter_prefix(self, prefix: str) -> Iterator[Tuple[str, array]]:
+        key = prefix.encode()
+        for term, postings_ind in self._iter_entries_from(key):
+            if not term.startswith(key):
+                break
+            yield term.decode(), self._read_postings(postings_ind)
+
+    def __getitem__(self, word: str) -> array:
+        postings_ind = self._find_postings(word)
+        if postings_ind is None:
+            raise KeyError(word)
+        return self._read_postings(postings_ind)
+
+    def __iter__(self) -> Iterator[str]:
+        for term, _ in self._iter_entries_from(b''):
+            yield term.decode()
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class OffsetTableIndex(MappedIndex):
+    """Index of versions 1-4, entries sorted by term with one '>Q' offset per entry in the table.
+
+    Entry is a '>B' term length, term and postings.
+    """
+
+    def _entry_offset(self, position: int) -> int:
+        return struct.unpack_from('>Q', self._bin_str, self._table_offset + position * _U_LONG_LONG_SIZE)[0]
+
+    def _read_term(self, position: int) -> Tuple[bytes, int]:
+        read_ind = self._entry_offset(position)
+        term_len = self._bin_str[read_ind]
+        read_ind += _U_CHAR_SIZE
+        return self._bin_str[read_ind:read_ind + term_len], read_ind + term_len
+
+    def _iter_entries_from(self, key: bytes) -> Iterator[Tuple[bytes, int]]:
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._read_term(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        for position in range(low, self._size):
+            yield self._read_term(position)
+
+
+def list_segment_paths(index_path: str) -> List[str]:
+    """Segments of index_path, segments already merged by an interrupted compaction are left out."""
+    segment_re = re.compile(re.escape(index_path + _SEGMENT_SUFFIX) + r'(\d+)')
+    merged_paths = set(read_compaction_manifest(index_path) or ()) if compaction_committed(index_path) else set()
+    segment_paths = [path for path in glob.glob(glob.escape(index_path + _SEGMENT_SUFFIX) + '*')
+                     if segment_re.fullmatch(path) and path not in merged_paths]
+    return sorted(segment_paths, key=lambda path: int(segment_re.fullmatch(path).group(1)))
+
+
+def read_compaction_manifest(index_path: str) -> Optional[List[str]]:
+    """Segments merged by compaction of index_path, None without compaction in progress."""
+    try:
+        with open(index_path + _COMPACTION_MANIFEST_SUFFIX, 'r') as fd:
+            segment_names = fd.read().split()
+    except FileNotFoundError:
+        return None
+    return [os.path.join(os.path.dirname(index_path), segment_name) for segment_name in segment_names]
+
+
+def compaction_committed(index_path: str) -> bool:
+    """Manifest is written after the merged index, so without merged index file it already replaced index_path."""
+    return (os.path.exists(index_path + _COMPACTION_MANIFEST_SUFFIX)
+            and not os.path.exists(index_path + _COMPACT_SUFFIX))
+
+
+def write_compaction_manifest(index_path: str, segment_paths: List[str]):
+    manifest_path = index_path + _COMPACTION_MANIFEST_SUFFIX
+    with open(manifest_path + '.tmp', 'w') as fd:
+        fd.write(''.join(os.path.basename(segment_path) + '\n' for segment_path in segment_paths))
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def finish_compaction(index_path: str):
+    """Roll forward compaction of index_path interrupted after its manifest was written."""
+    segment_paths = read_compaction_manifest(index_path)
+    if segment_paths is None:
+        return
+    if os.path.exists(index_path + _COMPACT_SUFFIX):
+        os.replace(index_path + _COMPACT_SUFFIX, index_path)
+    for segment_path in segment_paths:
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+    os.remove(index_path + _COMPACTION_MANIFEST_SUFFIX)
+
+
+def next_segment_path(index_path: str) -> str:
+    segment_paths = list_segment_paths(index_path)
+    segment_ind = int(segment_paths[-1][len(index_path + _SEGMENT_SUFFIX):]) + 1 if segment_paths else 1
+    return f'{index_path}{_SEGMENT_SUFFIX}{segment_ind}'
+
+
+class SegmentedIndex(Mapping):
+    """Read-only union of index segments, postings of a word are merged from all segments."""
+
+    def __init__(self, segments: List[Mapping]):
+        self.segments = segments
+        self._doc_lengths = None
+
+    @property
+    def doc_lengths(self) -> DocLengths:
+        if self._doc_lengths is None:
+            self._doc_lengths = DocLengths(*merge_scored_postings(
+                [(segment.doc_lengths.doc_ids, segment.doc_lengths.lengths) for segment in self.segments]))
+        return self._doc_lengths
+
+    @property
+    def total_doc_length(self) -> int:
+        return self.doc_lengths.total_length
+
+    def scored_postings(self, word: str) -> Optional[ScoredPostings]:
+        words_postings = [postings for postings in (segment.scored_postings(word) for segment in self.segments)
+                          if postings is not None]
+        if len(words_postings) == 0:
+            return None
+        if len(words_postings) == 1:
+            return words_postings[0]
+        docs, frequencies = merge_scored_postings([(postings.docs, postings.frequencies)
+                                                   for postings in words_postings])
+        return ScoredPostings(docs, frequencies, max(frequencies),
+                              min(postings.min_doc_length for postings in words_postings))
+
+    def __getitem__(self, word: str) -> array:
+        words_postings = [postings for postings in (segment.get(word) for segment in self.segments)
+                          if postings is not None]
+        if len(words_postings) == 0:
+            raise KeyError(word)
+        if len(words_postings) == 1 and isinstance(words_postings[0], array):
+            return words_postings[0]
+        return array(_DOC_ID_TYPECODE, sorted(set().union(*words_postings)))
+
+    def __iter__(self) -> Iterator[str]:
+        for word, _ in groupby(heapq.merge(*(sorted(segment) for segment in self.segments))):
+            yield word
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def is_prefix_pattern(word: str) -> bool:
+    return len(word) > len(_PREFIX_WILDCARD) and word.endswith(_PREFIX_WILDCARD)
+
+
+def iter_prefix_items(index: Mapping, prefix: str) -> Iterator[Tuple[str, Iterable[int]]]:
+    if isinstance(index, MappedIndex):
+        yield from index.iter_prefix(prefix)
+    elif isinstance(index, SegmentedIndex):
+        for segment in index.segments:
+            yield from iter_prefix_items(segment, prefix)
+    else:
+        yield from ((word, docs) for word, docs in index.items() if word.startswith(prefix))
+
+
+class QueryCache:
+    """Bounded LRU cache of intersected postings keyed by sorted unique query terms."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, terms: Tuple[str, ...]) -> Optional[array]:
+        with self._lock:
+            result = self._results.get(terms)
+            if result is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(terms)
+            self.hits += 1
+            return result
+
+    def put(self, terms: Tuple[str, ...], result: array):
+        with self._lock:
+            self._results[terms] = result
+            self._results.move_to_end(terms)
+            if len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+
 class InvertedIndex:
-    def __init__(self):
-        self.inverted_index = defaultdict(set)
+    def __init__(self, cache_size: int = 0, tokenizer: Optional[Tokenizer] = None, frequencies: bool = False):
+        self.frequencies = frequencies
+        self.inverted_index = TermPostings(frequencies)
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+
+    def tokenize(self, content: str) -> Iterable[str]:
+        if self.frequencies:
+            return self.tokenizer.count_terms(content)
+        return self.tokenizer.tokenize(content)
 
     def add_new_document(self, doc_id: int, content: str):
         if not isinstance(doc_id, int):
             raise ValueError(f'doc_id must be int, got {type(doc_id)}')
         if not isinstance(content, str):
             raise ValueError(f'content must be string, got {type(doc_id)}')
-        words = content.split()
-        for word in words:
-            self.inverted_index[word].add(doc_id)
+        self.add_terms(doc_id, self.tokenize(content))
+
+    def add_terms(self, doc_id: int, terms: Iterable[str]):
+        if self.cache is not None:
+            self.cache.clear()
+        self.inverted_index.add_document(doc_id, terms)
 
-    def build(self, fd: TextIO):
+    def build(self, fd: TextIO, workers: int = 1):
         if not hasattr(fd, 'read'):
             raise ValueError(f'expected file descriptor got {type(fd)}')
+        path = getattr(fd, 'name', None)
+        if workers > 1 and isinstance(path, str) and os.path.isfile(path):
+            self.build_parallel(path, fd.encoding, workers)
+            return
         for document in fd:
             doc_id, content = document.split(maxsplit=1)
             self.add_new_document(int(doc_id), content)
 
+    def build_parallel(self, path: str, encoding: str, workers: int):
+        chunks_count = max(workers, os.path.getsize(path) // _BUILD_CHUNK_SIZE)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build_chunk, path, start, end, encoding, self.tokenizer, self.frequencies)
+                       for start, end in split_file_chunks(path, chunks_count)]
+            for future in futures:
+                self.inverted_index.merge(future.result())
+
+    def build_external(self, fd: TextIO, output_fd: BinaryIO, memory_limit: int):
+        """Build index in runs of at most memory_limit bytes and merge runs into output_fd."""
+        if not hasattr(fd, 'read'):
+            raise ValueError(f'expected file descriptor got {type(fd)}')
+        with tempfile.TemporaryDirectory(prefix='inverted_index_') as runs_dir:
+            run_paths = []
+            postings_count = 0
+            for document in fd:
+                doc_id, content = document.split(maxsplit=1)
+                terms = self.tokenize(content)
+                self.add_terms(int(doc_id), terms)
+                postings_count += len(terms)
+                memory_usage = len(self.inverted_index) * _TERM_MEMORY_COST + postings_count * _POSTING_MEMORY_COST
+                if memory_usage >= memory_limit:
+                    run_paths.append(self.dump_run(runs_dir, len(run_paths)))
+                    postings_count = 0
+            if not run_paths:
+                self.dump(output_fd)
+                return
+            if self.inverted_index:
+                run_paths.append(self.dump_run(runs_dir, len(run_paths)))
+            self.merge_index_files(run_paths, output_fd)
+
+    def dump_run(self, runs_dir: str, run_ind: int) -> str:
+        run_path = os.path.join(runs_dir, f'run_{run_ind}.index')
+        with open(run_path, 'wb') as fd:
+            self.dump(fd)
+        self.inverted_index = TermPostings(self.frequencies)
+        return run_path
+
+    def merge_index_files(self, index_paths: List[str], output_fd: BinaryIO):
+        runs = []
+        for index_path in index_paths:
+            with open(index_path, 'rb') as fd:
+                runs.append(self.map_index(fd))
+        # postings of every term are merged on their own, runs of sequential input are concatenated
+        if self.frequencies:
+            runs_items = [run.iter_scored_postings() for run in runs]
+            merge_postings = merge_bounded_postings
+            doc_ranges = [(run_lengths.doc_ids[0], run_lengths.doc_ids[-1])
+                          for run_lengths in RunsDocLengths(runs).iter_runs() if len(run_lengths)]
+            if all(prev_range[1] < doc_range[0] for prev_range, doc_range in zip(doc_ranges, doc_ranges[1:])):
+                doc_lengths = RunsDocLengths(runs)
+            else:
+                doc_lengths = DocLengths(*merge_scored_postings([(run.doc_lengths.doc_ids, run.doc_lengths.lengths)
+                                                                 for run in runs]))
+        else:
+            runs_items = [run.iter_items() if isinstance(run, MappedIndex)
+                          else ((word, array(_DOC_ID_TYPECODE, sorted(docs))) for word, docs in sorted(run.items()))
+                          for run in runs]
+            merge_postings = union_postings
+            doc_lengths = None
+        merged_items = heapq.merge(*runs_items, key=operator.itemgetter(0))
+        self.dump_items(output_fd, ((word, merge_postings([docs for _, docs in word_items]))
+                                    for word, word_items in groupby(merged_items, key=operator.itemgetter(0))),
+                        doc_lengths)
+
+    def append_segment(self, fd: TextIO, index_path: str, max_segments: int = _MAX_SEGMENTS) -> str:
+        """Build index of new documents into the next segment of index_path."""
+        finish_compaction(index_path)
+        if os.path.exists(index_path):
+            self.load_flags(index_path)
+        self.build(fd)
+        segment_path = next_segment_path(index_path) if os.path.exists(index_path) else index_path
+        with open(segment_path, 'wb') as segment_fd:
+            self.dump(segment_fd)
+        if len(list_segment_paths(index_path)) > max_segments:
+            self.compact(index_path)
+        return segment_path
+
+    def compact(self, index_path: str):
+        """Merge all segments into index_path, replacing it atomically.
+
+        Merged segments are listed in a manifest before the replace, so after
+        a crash they are not loaded again and the next compaction or append
+        finishes removing them.
+        """
+        finish_compaction(index_path)
+        segment_paths = list_segment_paths(index_path)
+        if len(segment_paths) == 0:
+            return
+        self.load_flags(index_path)
+        compact_path = index_path + _COMPACT_SUFFIX
+        with open(compact_path, 'wb') as fd:
+            self.merge_index_files([index_path] + segment_paths, fd)
+        write_compaction_manifest(index_path, segment_paths)
+        finish_compaction(index_path)
+
     @staticmethod
     def encode_string(word: str) -> bytes:
         encoded_word = word.encode()
@@ -69,16 +1037,115 @@ class InvertedIndex:
         read_bytes += str_len
         return binary_word.decode(), read_bytes
 
+    @staticmethod
+    def encode_postings(docs: Iterable[int]) -> bytes:
+        """Encode doc ids, arrays are taken as sorted postings and other collections are sorted."""
+        if not isinstance(docs, array):
+            docs = sorted(docs)
+            if docs and not 0 <= docs[0] <= docs[-1] <= _MAX_DOC_ID:
+                raise ValueError(f'doc_id must be in range [0, {_MAX_DOC_ID}]')
+            docs = array(_DOC_ID_TYPECODE, docs)
+        gaps = doc_gaps(docs)
+        gap_width = value_width(max(gaps, default=0))
+        return encode_varint(len(docs)) + struct.pack('>B', gap_width) + pack_width(gaps, gap_width)
+
+    @staticmethod
+    def decode_postings(bin_str: bytes, start_ind: int) -> Tuple[array, int]:
+        set_size, read_bytes = decode_varint(bin_str, start_ind)
+        gap_width = bin_str[start_ind + read_bytes]
+        read_bytes += _U_CHAR_SIZE
+        doc_gaps = decode_packed(bin_str, start_ind + read_bytes, set_size, _GAP_TYPECODES[gap_width])
+        return array(_DOC_ID_TYPECODE, accumulate(doc_gaps)), read_bytes + set_size * gap_width
+
+    @staticmethod
+    def encode_scored_postings(docs: array, frequencies: array, doc_lengths: Mapping) -> bytes:
+        min_doc_length = min((doc_lengths[doc_id] for doc_id in docs), default=0)
+        return InvertedIndex.encode_bounded_postings(
+            ScoredPostings(docs, frequencies, max(frequencies, default=0), min_doc_length))
+
+    @staticmethod
+    def encode_bounded_postings(postings: ScoredPostings) -> bytes:
+        return (encode_varint(postings.max_frequency) + encode_varint(postings.min_doc_length)
+                + InvertedIndex.encode_postings(postings.docs) + pack_values(postings.frequencies))
+
+    @staticmethod
+    def decode_scored_postings(bin_str: bytes, start_ind: int) -> Tuple[ScoredPostings, int]:
+        max_frequency, read_bytes = decode_varint(bin_str, start_ind)
+        min_doc_length, varint_bytes = decode_varint(bin_str, start_ind + read_bytes)
+        read_bytes += varint_bytes
+        docs, postings_bytes = InvertedIndex.decode_postings(bin_str, start_ind + read_bytes)
+        read_bytes += postings_bytes
+        frequencies, packed_bytes = unpack_values(bin_str, start_ind + read_bytes, len(docs))
+        return ScoredPostings(docs, frequencies, max_frequency, min_doc_length), read_bytes + packed_bytes
+
+    @staticmethod
+    def encode_terms_block(block: List[Tuple[bytes, int]]) -> bytes:
+        bin_block = bytearray()
+        prev_term = b''
+        prev_postings_ind = 0
+        for term, postings_ind in block:
+            shared_len = len(os.path.commonprefix((prev_term, term)))
+            bin_block += encode_varint(shared_len) + encode_varint(len(term) - shared_len) + term[shared_len:]
+            bin_block += encode_varint(postings_ind - prev_postings_ind)
+            prev_term, prev_postings_ind = term, postings_ind
+        return bytes(bin_block)
+
+    def dump_items(self, fd: BinaryIO, items: Iterable[Tuple[str, Iterable[int]]],
+                   doc_lengths: Optional[Mapping] = None):
+        """Write index block by block, items must be sorted by word.
+
+        With doc_lengths, item postings are pairs of sorted doc ids and their term frequencies
+        or ScoredPostings with their bounds, doc_lengths may be RunsDocLengths of merged runs.
+        """
+        flags = self.tokenizer.flags | (_FREQUENCIES_FLAG if doc_lengths is not None else 0)
+        fd.write(struct.pack(_HEADER_FORMAT, _INDEX_MAGIC, _INDEX_VERSION, flags))
+        block_offsets = array('Q')
+        terms_count = 0
+        write_ind = _HEADER_SIZE
+        items = iter(items)
+        while block_items := list(islice(items, _TERMS_PER_BLOCK)):
+            block = []
+            for word, docs in block_items:
+                if doc_lengths is None:
+                    bin_postings = self.encode_postings(docs)
+                elif isinstance(docs, ScoredPostings):
+                    bin_postings = self.encode_bounded_postings(docs)
+                else:
+                    bin_postings = self.encode_scored_postings(*docs, doc_lengths)
+                block.append((word.encode(), write_ind))
+                write_ind += len(bin_postings)
+                fd.write(bin_postings)
+            block_offsets.append(write_ind)
+            bin_block = self.encode_terms_block(block)
+            write_ind += len(bin_block)
+            fd.write(bin_block)
+            terms_count += len(block)
+        if sys.byteorder == 'little':
+            block_offsets.byteswap()
+        fd.write(block_offsets.tobytes())
+        if isinstance(doc_lengths, RunsDocLengths):
+            for bin_part in doc_lengths.encode():
+                fd.write(bin_part)
+        elif doc_lengths is not None:
+            doc_ids = sorted(doc_lengths)
+            fd.write(self.encode_postings(doc_ids) + pack_values(doc_lengths[doc_id] for doc_id in doc_ids))
+        if doc_lengths is not None:
+            fd.write(struct.pack('>Q', write_ind + len(block_offsets) * _U_LONG_LONG_SIZE))
+        fd.write(struct.pack(_FOOTER_FORMAT, terms_count, write_ind))
+
     def encode_dict(self, conv_dict: DefaultDict[str, set]) -> bytes:
-        bin_str = struct.pack('>i', len(conv_dict))
-        bin_str += b''.join([self.encode_string(key)
-                             + struct.pack('>H', len(docs_set))
-                             + b''.join([struct.pack('>H', doc_id) for doc_id in docs_set])
-                             for key, docs_set in conv_dict.items()
-                             ])
-        return bin_str
-
-    def decode_dict(self, bin_str: bytes) -> DefaultDict[str, set]:
+        bin_str = BytesIO()
+        self.dump_items(bin_str, ((key, conv_dict[key]) for key in sorted(conv_dict)))
+        return bin_str.getvalue()
+
+    def decode_dict(self, bin_str: bytes) -> Mapping:
+        if bin_str[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+            return self.decode_legacy_dict(bin_str)
+        if bin_str[len(_INDEX_MAGIC)] < _INDEX_VERSION:
+            return OffsetTableIndex(bin_str)
+        return MappedIndex(bin_str)
+
+    def decode_legacy_dict(self, bin_str: bytes) -> DefaultDict[str, set]:
         read_dict = defaultdict(set)
         dict_size = struct.unpack('>i', bin_str[:_INT_SIZE])[0]
         read_ind = _INT_SIZE
@@ -97,41 +1164,185 @@ class InvertedIndex:
     def dump(self, fd: BinaryIO):
         if not hasattr(fd, 'write'):
             raise ValueError(f'expected file descriptor got {type(fd)}')
-        bin_dict = self.encode_dict(self.inverted_index)
-        fd.write(bin_dict)
+        writer = BufferedWriter(fd) if isinstance(fd, RawIOBase) else fd
+        if self.frequencies:
+            self.dump_items(writer, self.inverted_index.iter_scored_items(), self.inverted_index.doc_lengths)
+        else:
+            self.dump_items(writer, ((word, self.inverted_index[word]) for word in sorted(self.inverted_index)))
+        writer.flush()
+        if writer is not fd:
+            writer.detach()
+
+    def map_index(self, fd: BinaryIO) -> Mapping:
+        try:
+            bin_dict = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            bin_dict = fd.read()
+        return self.decode_dict(bin_dict)
+
+    def set_flags(self, flags: int):
+        self.tokenizer = Tokenizer.from_flags(flags)
+        self.frequencies = bool(flags & _FREQUENCIES_FLAG)
+
+    def load_flags(self, index_path: str):
+        """Use tokenizer and frequencies of index_path for documents added next."""
+        with open(index_path, 'rb') as fd:
+            self.set_flags(getattr(self.map_index(fd), 'flags', 0))
+        self.inverted_index = TermPostings(self.frequencies)
 
     def load(self, fd: BinaryIO):
         if not hasattr(fd, 'read'):
             raise ValueError(f'expected file descriptor got {type(fd)}')
-        bin_dict = fd.read()
-        self.inverted_index = self.decode_dict(bin_dict)
+        self.inverted_index = self.map_index(fd)
+        self.set_flags(getattr(self.inverted_index, 'flags', 0))
+        index_path = getattr(fd, 'name', None)
+        segment_paths = list_segment_paths(index_path) if isinstance(index_path, str) else []
+        if segment_paths:
+            segments = [self.inverted_index]
+            for segment_path in segment_paths:
+                with open(segment_path, 'rb') as segment_fd:
+                    segments.append(self.map_index(segment_fd))
+            self.inverted_index = SegmentedIndex(segments)
+        if self.cache is not None:
+            self.cache.clear()
 
     @staticmethod
-    def parse_queries(args: Namespace):
+    def iter_queries(args: Namespace) -> Iterator[List[str]]:
         if args.query:
-            queries = args.query
+            yield from args.query
+            return
+        query_fd = args.query_file_utf8 if args.query_file_utf8 else args.query_file_cp1251
+        if not hasattr(query_fd, 'read'):
+            raise ValueError(f'expected file descriptor got {type(query_fd)}')
+        for query_words in query_fd:
+            yield query_words.split()
+
+    @staticmethod
+    def parse_queries(args: Namespace):
+        return list(InvertedIndex.iter_queries(args))
+
+    def get_postings(self, word: str) -> array:
+        if is_prefix_pattern(word):
+            words_postings = [docs for _, docs in iter_prefix_items(self.inverted_index, word[:-1])]
+            docs = words_postings[0] if len(words_postings) == 1 else set().union(*words_postings)
         else:
-            query_fd = args.query_file_utf8 if args.query_file_utf8 else args.query_file_cp1251
-            if not hasattr(query_fd, 'read'):
-                raise ValueError(f'expected file descriptor got {type(query_fd)}')
-            queries = []
-            for query_words in query_fd:
-                queries.append(query_words.split())
-        return queries
+            docs = self.inverted_index.get(word, ())
+        if isinstance(docs, array):
+            return docs
+        return array(_DOC_ID_TYPECODE, sorted(docs))
+
+    def intersect_terms(self, terms: Tuple[str, ...], terms_postings: Optional[Dict[str, array]] = None,
+                        cache: Optional[QueryCache] = None) -> array:
+        if terms_postings is None:
+            terms_postings = {term: self.get_postings(term) for term in terms}
+        rare_terms = sorted(terms, key=lambda term: len(terms_postings[term]))
+        output = terms_postings[rare_terms[0]]
+        rest_terms = rare_terms[1:]
+        if cache is not None and len(rare_terms) > 2:
+            output = self.cached_intersect_terms(tuple(sorted(rare_terms[:2])), cache, terms_postings)
+            rest_terms = rare_terms[2:]
+        for term in rest_terms:
+            if len(output) == 0:
+                break
+            output = intersect_postings(output, terms_postings[term])
+        return output
+
+    def cached_intersect_terms(self, terms: Tuple[str, ...], cache: QueryCache,
+                               terms_postings: Optional[Dict[str, array]] = None) -> array:
+        output = cache.get(terms)
+        if output is None:
+            output = self.intersect_terms(terms, terms_postings, cache)
+            cache.put(terms, output)
+        return output
 
     def query(self, words: List[str]) -> set:
-        if len(words) == 0:
+        terms = tuple(sorted(self.tokenizer.tokenize_query(words)))
+        if len(terms) == 0:
             return set()
-        output = self.inverted_index[words[0]]
-        for word in words[1:]:
-            output = output.intersection(self.inverted_index[word])
-        return output
+        if self.cache is None:
+            return set(self.intersect_terms(terms))
+        return set(self.cached_intersect_terms(terms, self.cache))
+
+    def run_batch(self, queries: Iterable[List[str]], batch_size: int = _QUERY_BATCH_SIZE) -> Iterator[str]:
+        """Answer queries like find_articles, decoding postings of every term once per batch."""
+        queries = iter(queries)
+        while batch := list(islice(queries, batch_size)):
+            batch_terms = [tuple(sorted(self.tokenizer.tokenize_query(words))) for words in batch]
+            terms_postings = {term: self.get_postings(term) for terms in batch_terms for term in terms}
+            batch_cache = self.cache if self.cache is not None else QueryCache(2 * len(batch))
+            for terms in batch_terms:
+                if len(terms) == 0:
+                    yield ''
+                    continue
+                output = self.cached_intersect_terms(terms, batch_cache, terms_postings)
+                yield ','.join(map(str, set(output)))
+
+    def get_scored_postings(self, word: str) -> List[ScoredPostings]:
+        words = [word]
+        if is_prefix_pattern(word):
+            words = sorted({prefix_word for prefix_word, _ in iter_prefix_items(self.inverted_index, word[:-1])})
+        return [postings for postings in map(self.inverted_index.scored_postings, words) if postings is not None]
+
+    def rank(self, words: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """Top k docs matching any of the words with their BM25 scores."""
+        if not self.frequencies:
+            raise ValueError('ranking needs inverted index built with term frequencies')
+        doc_lengths = self.inverted_index.doc_lengths
+        if len(doc_lengths) == 0:
+            return []
+        terms_postings = [postings for term in sorted(self.tokenizer.tokenize_query(words))
+                          for postings in self.get_scored_postings(term)]
+        return max_score_top_k(terms_postings, doc_lengths, self.inverted_index.total_doc_length / len(doc_lengths),
+                               top_k)
+
+    def find_top_articles(self, words: List[str], top_k: int) -> str:
+        return ','.join(str(doc_id) for doc_id, _ in self.rank(words, top_k))
 
     def find_articles(self, words):
         answer = ','.join(map(str, self.query(words)))
         return answer
 
 
+class QueryServer:
+    """Answer line queries over a loaded index, one answer line per query line."""
+
+    def __init__(self, index: InvertedIndex, latency_fd: TextIO = sys.stderr):
+        self.index = index
+        self.latency_fd = latency_fd
+
+    def answer(self, query_line: str) -> str:
+        start_time = time.perf_counter()
+        answer = self.index.find_articles(query_line.split())
+        latency = (time.perf_counter() - start_time) * _MILLISECONDS_IN_SECOND
+        print(f'{latency:.3f} ms\t{query_line.strip()}', file=self.latency_fd)
+        return answer
+
+    def serve_stdio(self, input_fd: TextIO, output_fd: TextIO):
+        for query_line in input_fd:
+            print(self.answer(query_line), file=output_fd, flush=True)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        try:
+            while query_line := await reader.readline():
+                answer = await loop.run_in_executor(executor, self.answer, query_line.decode())
+                writer.write(answer.encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start_tcp(self, host: str, port: int, executor: ThreadPoolExecutor) -> asyncio.AbstractServer:
+        return await asyncio.start_server(lambda reader, writer: self.handle_client(reader, writer, executor),
+                                          host, port)
+
+    async def serve_tcp(self, host: str, port: int, threads: int):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            server = await self.start_tcp(host, port, executor)
+            async with server:
+                await server.serve_forever()
+
+
 def setup_parser(arg_parser):
     sub_parsers = arg_parser.add_subparsers(help='choose command')
     build_parser = sub_parsers.add_parser(
@@ -150,6 +1361,35 @@ def setup_parser(arg_parser):
         metavar='OUTPUT_INDEX_PATH',
         type=FileType('wb'),
     )
+    build_parser.add_argument(
+        '--lowercase',
+        help='lowercase words of documents and queries',
+        action='store_true',
+    )
+    build_parser.add_argument(
+        '--strip-punctuation',
+        help='strip punctuation around words of documents and queries',
+        action='store_true',
+    )
+    build_parser.add_argument(
+        '--frequencies',
+        help='store term frequencies and document lengths for ranked queries',
+        action='store_true',
+    )
+    build_mode_group = build_parser.add_mutually_exclusive_group()
+    build_mode_group.add_argument(
+        '-w', '--workers',
+        help='number of processes building parts of inverted index',
+        metavar='WORKERS',
+        type=int,
+        default=1,
+    )
+    build_mode_group.add_argument(
+        '-m', '--memory-limit',
+        help='build inverted index in sorted runs of at most this size in megabytes',
+        metavar='MEGABYTES',
+        type=int,
+    )
     build_parser.set_defaults(command='build')
     query_parser = sub_parsers.add_parser(
         'query',
@@ -166,7 +1406,7 @@ def setup_parser(arg_parser):
     )
     query_args_group.add_argument(
         '-q', '--query',
-        help='list of words in documents for search',
+        help='list of words in documents for search, word ending with * matches all words with this prefix',
         action='append',
         metavar='WORD',
         nargs='+',
@@ -184,7 +1424,100 @@ def setup_parser(arg_parser):
         metavar='QUERY_FILE_PATH',
         type=EncodedFileType('r', encoding='utf-8'),
     )
+    query_parser.add_argument(
+        '--cache-size',
+        help='number of query results kept in LRU cache',
+        metavar='CACHE_SIZE',
+        type=int,
+        default=0,
+    )
+    query_parser.add_argument(
+        '--batch-size',
+        help='number of queries sharing decoded postings and intersections',
+        metavar='BATCH_SIZE',
+        type=int,
+        default=_QUERY_BATCH_SIZE,
+    )
+    query_parser.add_argument(
+        '--top-k',
+        help='answer with at most K best ranked documents matching any of query words',
+        metavar='K',
+        type=int,
+    )
+    query_parser.add_argument(
+        '--rank',
+        help='ranking function used with --top-k, index must be built with --frequencies',
+        choices=['bm25'],
+        default='bm25',
+    )
     query_parser.set_defaults(command='query')
+    serve_parser = sub_parsers.add_parser(
+        'serve',
+        help='load inverted index once and answer queries line by line',
+    )
+    serve_parser.add_argument(
+        '-i', '--index',
+        help='path to constructed inverted index',
+        metavar='INDEX_PATH',
+        type=FileType('rb'),
+    )
+    serve_parser.add_argument(
+        '--host',
+        help='host to listen on, used with --port',
+        default='127.0.0.1',
+    )
+    serve_parser.add_argument(
+        '-p', '--port',
+        help='port to listen on, queries are read from stdin if not set',
+        type=int,
+    )
+    serve_parser.add_argument(
+        '-t', '--threads',
+        help='number of threads answering queries of tcp clients',
+        type=int,
+        default=4,
+    )
+    serve_parser.add_argument(
+        '--cache-size',
+        help='number of query results kept in LRU cache',
+        metavar='CACHE_SIZE',
+        type=int,
+        default=0,
+    )
+    serve_parser.set_defaults(command='serve')
+    append_parser = sub_parsers.add_parser(
+        'append',
+        help='build inverted index of new documents as an additional segment',
+    )
+    append_parser.add_argument(
+        '-d', '--dataset',
+        help='path to dataset file with new documents',
+        metavar='INPUT_DATASET_PATH',
+        type=FileType('r'),
+    )
+    append_parser.add_argument(
+        '-i', '--index',
+        help='path to constructed inverted index',
+        metavar='INDEX_PATH',
+    )
+    append_parser.add_argument(
+        '--max-segments',
+        help='compact inverted index when number of segments exceeds this value',
+        metavar='MAX_SEGMENTS',
+        type=int,
+        default=_MAX_SEGMENTS,
+    )
+    append_parser.set_defaults(command='append')
+    compact_parser = sub_parsers.add_parser(
+        'compact',
+        help='merge all segments of inverted index into one file',
+    )
+    compact_parser.add_argument(
+        '-i', '--index',
+        help='path to constructed inverted index',
+        metavar='INDEX_PATH',
+    )
+    compact_parser.set_defaults(command='compact')
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
@@ -197,14 +1530,42 @@ if __name__ == '__main__':
     )
     setup_parser(parser)
     arguments = parser.parse_args()
-    index = InvertedIndex()
+    index = InvertedIndex(getattr(arguments, 'cache_size', 0),
+                          Tokenizer(getattr(arguments, 'lowercase', False),
+                                    getattr(arguments, 'strip_punctuation', False)),
+                          getattr(arguments, 'frequencies', False))
 
     if arguments.command == 'build':
-        index.build(arguments.dataset)
-        index.dump(arguments.output)
+        if arguments.memory_limit:
+            index.build_external(arguments.dataset, arguments.output, arguments.memory_limit * _BYTES_IN_MEGABYTE)
+        else:
+            index.build(arguments.dataset, arguments.workers)
+            index.dump(arguments.output)
     elif arguments.command == 'query':
         index.load(arguments.index)
-        answers = []
-        for query in index.parse_queries(arguments):
-            answers.append(index.find_articles(query))
-        print(*answers, sep='\n')
+        if arguments.top_k is not None and not index.frequencies:
+            parser.error('the argument --top-k requires inverted index built with --frequencies')
+        if arguments.top_k is not None:
+            answers = (index.find_top_articles(words, arguments.top_k) for words in index.iter_queries(arguments))
+        else:
+            answers = index.run_batch(index.iter_queries(arguments), arguments.batch_size)
+        for answer in answers:
+            print(answer)
+        if index.cache is not None:
+            print(f'cache hits: {index.cache.hits}, misses: {index.cache.misses}', file=sys.stderr)
+    elif arguments.command == 'append':
+        index.append_segment(arguments.dataset, arguments.index, arguments.max_segments)
+    elif arguments.command == 'compact':
+        index.compact(arguments.index)
+    elif arguments.command == 'serve':
+        index.load(arguments.index)
+        query_server = QueryServer(index)
+        try:
+            if arguments.port is None:
+                query_server.serve_stdio(sys.stdin, sys.stdout)
+            else:
+                asyncio.run(query_server.serve_tcp(arguments.host, arguments.port, arguments.threads))
+        except KeyboardInterrupt:
+            pass
+        if index.cache is not None:
+            print(f'cache hits: {index.cache.hits}, misses: {index.cache.misses}', file=sys.stderr)
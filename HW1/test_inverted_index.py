@@ -1,18 +1,63 @@
 import os
+import sys
+import random
+import struct
+import asyncio
+import subprocess
+from io import StringIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from array import array
 from argparse import Namespace
 from collections import defaultdict
 
-from inverted_index import InvertedIndex
+from inverted_index import InvertedIndex, MappedIndex, QueryServer, QueryCache, SegmentedIndex, Tokenizer, \
+    TermPostings, ScoredPostings, split_file_chunks, list_segment_paths, encode_varint, decode_varint, \
+    decode_varints, gallop_search, intersect_postings, bm25_idf, bm25_term_score, union_postings, \
+    merge_bounded_postings
 
 ONE_ARTICLE_PATH = 'one_article_wikipedia.txt'
+_RANKED_DOCS = ['1 foo bar foo', '2 foo baz', '3 bar bar bar baz qux', '4 qux', '5 foo foo foo foo bar',
+                '6 baz qux qux', '7 foo']
 _SMALL_INDEX = defaultdict(set, {'TitleOne': {1}, 'TitleTwo': {2},
                                  'TitleThree': {3}, 'word': {1, 3},
                                  'simple': {1},
                                  })
 
 
+def postings_as_sets(index):
+    return {word: set(docs) for word, docs in index.items()}
+
+
+def build_ranked_index(docs):
+    index = InvertedIndex(frequencies=True)
+    for document in docs:
+        doc_id, content = document.split(maxsplit=1)
+        index.add_new_document(int(doc_id), content)
+    return index
+
+
+def rank_exhaustive(inverted_index, terms, top_k):
+    doc_lengths = inverted_index.doc_lengths
+    avg_doc_length = inverted_index.total_doc_length / len(doc_lengths)
+    scores = defaultdict(float)
+    for term in terms:
+        postings = inverted_index.scored_postings(term)
+        if postings is None:
+            continue
+        idf = bm25_idf(len(doc_lengths), len(postings.docs))
+        for doc_id, frequency in zip(postings.docs, postings.frequencies):
+            scores[doc_id] += bm25_term_score(idf, frequency, doc_lengths[doc_id], avg_doc_length)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+def same_ranking(expected, ranking):
+    return (len(expected) == len(ranking)
+            and [score for _, score in expected] == pytest.approx([score for _, score in ranking])
+            and dict(expected).keys() == dict(ranking).keys())
+
+
 def test_build_value_is_file_descriptor():
     with pytest.raises(ValueError):
         InvertedIndex().build(fd=2)
@@ -28,7 +73,79 @@ def test_build_small_index():
     wiki_path = 'small_test.txt'
     with open(wiki_path, 'r') as fd:
         index.build(fd)
-    assert index.inverted_index == _SMALL_INDEX, f'wrong build index from {wiki_path}'
+    assert postings_as_sets(index.inverted_index) == _SMALL_INDEX, f'wrong build index from {wiki_path}'
+
+
+@pytest.mark.parametrize('chunks_count', [1, 2, 3, 10])
+def test_split_file_chunks(chunks_count):
+    wiki_path = 'small_test.txt'
+    chunks = split_file_chunks(wiki_path, chunks_count)
+    with open(wiki_path, 'rb') as fd:
+        data = fd.read()
+    assert b''.join(data[start:end] for start, end in chunks) == data, 'chunks dont cover the whole file'
+    assert all(data[end - 1:end] == b'\n' for _, end in chunks[:-1]), 'chunk ends in the middle of a line'
+
+
+def test_build_parallel_same_as_single_process(tmp_path):
+    wiki_path = 'small_test.txt'
+    dumps = []
+    for workers in (1, 2):
+        index = InvertedIndex()
+        with open(wiki_path, 'r') as fd:
+            index.build(fd, workers=workers)
+        index_path = tmp_path / f'{workers}.index'
+        with open(index_path, 'wb') as fd:
+            index.dump(fd)
+        dumps.append(index_path.read_bytes())
+    assert dumps[0] == dumps[1], 'parallel build differs from single process build'
+
+
+@pytest.mark.parametrize('memory_limit', [1, 10 ** 9])
+def test_build_external_same_as_in_memory(tmp_path, memory_limit):
+    index = InvertedIndex()
+    with open(ONE_ARTICLE_PATH, 'r') as fd:
+        index.build(fd)
+    expected = index.encode_dict(index.inverted_index)
+
+    index_path = tmp_path / 'external.index'
+    with open(ONE_ARTICLE_PATH, 'r') as fd, open(index_path, 'wb') as output_fd:
+        InvertedIndex().build_external(fd, output_fd, memory_limit)
+    assert expected == index_path.read_bytes(), 'external build differs from in memory build'
+
+
+@pytest.mark.parametrize('words_postings, expected', [
+    ([[1, 2], [4], [7, 9]], [1, 2, 4, 7, 9]),
+    ([[1, 5], [3], [], [5, 6]], [1, 3, 5, 6]),
+])
+def test_union_postings(words_postings, expected):
+    assert array('I', expected) == union_postings([array('I', docs) for docs in words_postings]), (
+        'wrong union of postings')
+
+
+@pytest.mark.parametrize('words_postings, expected', [
+    ([([1, 2], [3, 1], 3, 4), ([4], [2], 2, 2)], ([1, 2, 4], [3, 1, 2], 3, 2)),
+    ([([1, 4], [3, 1], 3, 4), ([4], [2], 2, 2)], ([1, 4], [3, 3], 3, 2)),
+])
+def test_merge_bounded_postings(words_postings, expected):
+    merged = merge_bounded_postings([ScoredPostings(array('I', docs), array('I', frequencies), max_frequency,
+                                                    min_doc_length)
+                                     for docs, frequencies, max_frequency, min_doc_length in words_postings])
+    assert expected == (list(merged.docs), list(merged.frequencies), merged.max_frequency, merged.min_doc_length)
+
+
+def test_merge_index_files(tmp_path):
+    index_paths = []
+    for run_ind, run_dict in enumerate([{'foo': {1, 2}, 'bar': {3}}, {'foo': {4}, 'baz': {4}}]):
+        index_paths.append(tmp_path / f'run_{run_ind}.index')
+        index_paths[-1].write_bytes(InvertedIndex().encode_dict(run_dict))
+    merged_path = tmp_path / 'merged.index'
+    with open(merged_path, 'wb') as fd:
+        InvertedIndex().merge_index_files(index_paths, fd)
+    index = InvertedIndex()
+    with open(merged_path, 'rb') as fd:
+        index.load(fd)
+    assert {'foo': {1, 2, 4}, 'bar': {3}, 'baz': {4}} == postings_as_sets(index.inverted_index), (
+        'wrong merge of index files')
 
 
 def test_add_new_doc_doc_id_not_int_value():
@@ -61,6 +178,72 @@ def test_add_new_doc_multi_word():
     assert doc_id in foo_index.inverted_index[word_2.strip()], assert_mes
 
 
+@pytest.mark.parametrize('lowercase, strip_punctuation, expected_terms', [
+    (False, False, {'Word', 'word,', '(word)', 'Слово', '—'}),
+    (True, False, {'word', 'word,', '(word)', 'слово', '—'}),
+    (False, True, {'Word', 'word', 'Слово'}),
+    (True, True, {'word', 'слово'}),
+])
+def test_tokenizer(lowercase, strip_punctuation, expected_terms):
+    tokenizer = Tokenizer(lowercase, strip_punctuation)
+    assert expected_terms == tokenizer.tokenize('Word word, (word) Слово — word,'), 'wrong tokenized terms'
+    assert (lowercase, strip_punctuation) == (Tokenizer.from_flags(tokenizer.flags).lowercase,
+                                              Tokenizer.from_flags(tokenizer.flags).strip_punctuation), (
+        'wrong tokenizer flags')
+
+
+def test_term_postings_unordered_docs():
+    postings = TermPostings()
+    for doc_id in [5, 1, 9, 5, 3]:
+        postings.add('foo', doc_id)
+    postings.update('foo', [2, 9, 10])
+    postings.add('bar', 1)
+    assert array('I', [1, 2, 3, 5, 9, 10]) == postings['foo'], 'postings are not sorted or have duplicates'
+    assert {'foo': 0, 'bar': 1} == postings.term_ids, 'wrong dense term ids'
+
+
+def test_term_postings_frequencies():
+    postings = TermPostings(frequencies=True)
+    postings.add_document(5, {'foo': 2, 'bar': 1})
+    postings.add_document(1, Tokenizer(lowercase=True).count_terms('Foo foo FOO'))
+    postings.add_document(5, {'foo': 1})
+    assert array('I', [1, 5]) == postings['foo'], 'postings are not sorted or have duplicates'
+    assert (3, 3) == tuple(postings.scored_postings('foo')[2:]), 'wrong max frequency and min doc length'
+    assert array('I', [3, 3]) == postings.scored_postings('foo').frequencies, 'wrong frequencies of unordered docs'
+    assert {5: 4, 1: 3} == postings.doc_lengths and 7 == postings.total_doc_length, 'wrong doc lengths'
+
+
+@pytest.mark.parametrize('frequencies', [False, True])
+def test_term_postings_merge(frequencies):
+    postings = TermPostings(frequencies=frequencies)
+    postings.add_document(3, ['foo', 'bar'])
+    for doc_id, terms in [(5, ['foo']), (7, ['foo', 'foo']), (1, ['bar'])]:
+        other = TermPostings(frequencies=frequencies)
+        other.add_document(doc_id, terms)
+        postings.merge(other)
+    assert array('I', [3, 5, 7]) == postings['foo'], 'appended postings are wrong'
+    assert array('I', [1, 3]) == postings['bar'], 'postings merged before last doc are not sorted'
+    if frequencies:
+        assert array('I', [1, 1, 2]) == postings.scored_postings('foo').frequencies, 'wrong appended frequencies'
+        assert array('I', [1, 1]) == postings.scored_postings('bar').frequencies, 'wrong inserted frequencies'
+
+
+def test_normalized_index_dump_load_query(tmp_path):
+    index = InvertedIndex(tokenizer=Tokenizer(lowercase=True, strip_punctuation=True))
+    index.add_new_document(1, 'Hello, World!')
+    index.add_new_document(2, 'hello again')
+    index_path = tmp_path / 'normalized.index'
+    with open(index_path, 'wb') as fd:
+        index.dump(fd)
+    loaded_index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        loaded_index.load(fd)
+    assert loaded_index.tokenizer.lowercase and loaded_index.tokenizer.strip_punctuation, (
+        'normalization was not loaded from index')
+    assert {1} == loaded_index.query(['HELLO', 'world?']), 'query words were not normalized'
+    assert set() == loaded_index.query(['...']), 'find a doc with query of punctuation only'
+
+
 def test_dump_value_is_file_descriptor():
     with pytest.raises(ValueError):
         InvertedIndex().dump(fd=2)
@@ -79,6 +262,69 @@ def test_dump_small_index():
     assert os.path.getsize(small_index_path) > 0, 'build index with zero size'
 
 
+def test_dump_streams_entries():
+    class WritesRecorder:
+        def __init__(self):
+            self.writes = []
+
+        def write(self, bin_str):
+            self.writes.append(bytes(bin_str))
+
+        def flush(self):
+            pass
+
+    index = InvertedIndex()
+    index.inverted_index = _SMALL_INDEX
+    fd = WritesRecorder()
+    index.dump(fd)
+    assert b''.join(fd.writes) == index.encode_dict(_SMALL_INDEX), 'streamed dump differs from encoded index'
+    assert len(fd.writes) > len(_SMALL_INDEX), 'dump writes index as one binary string'
+
+
+def test_dump_unbuffered_file(tmp_path):
+    index = InvertedIndex()
+    index.inverted_index = _SMALL_INDEX
+    index_path = tmp_path / 'small.index'
+    with open(index_path, 'wb', buffering=0) as fd:
+        index.dump(fd)
+    assert index_path.read_bytes() == index.encode_dict(_SMALL_INDEX), 'wrong dump into unbuffered file'
+
+
+def test_append_segments_and_compact(tmp_path):
+    index_path = str(tmp_path / 'inv.index')
+    datasets = ['1 foo bar\n2 foo\n', '3 foo bar baz\n', '4 bar\n1 baz\n']
+    for dataset_ind, dataset in enumerate(datasets):
+        dataset_path = tmp_path / f'dataset_{dataset_ind}.txt'
+        dataset_path.write_text(dataset)
+        with open(dataset_path, 'r') as fd:
+            InvertedIndex().append_segment(fd, index_path)
+    assert 2 == len(list_segment_paths(index_path)), 'new documents were not appended as segments'
+
+    index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        index.load(fd)
+    assert isinstance(index.inverted_index, SegmentedIndex), 'segments were not loaded'
+    assert ['bar', 'baz', 'foo'] == list(index.inverted_index), 'wrong words in segmented index'
+    assert {1, 3} == index.query(['bar', 'baz']), 'didnt find docs from different segments'
+
+    InvertedIndex().compact(index_path)
+    assert [] == list_segment_paths(index_path), 'segments were not removed after compaction'
+    with open(index_path, 'rb') as fd:
+        index.load(fd)
+    assert {'foo': {1, 2, 3}, 'bar': {1, 3, 4}, 'baz': {1, 3}} == postings_as_sets(index.inverted_index), (
+        'wrong compacted index')
+
+
+def test_append_segment_compacts_many_segments(tmp_path):
+    index_path = str(tmp_path / 'inv.index')
+    dataset_path = tmp_path / 'dataset.txt'
+    for doc_id in range(4):
+        dataset_path.write_text(f'{doc_id} foo\n')
+        with open(dataset_path, 'r') as fd:
+            InvertedIndex().append_segment(fd, index_path, max_segments=2)
+    assert len(list_segment_paths(index_path)) <= 2, 'segments were not compacted'
+
+
 def test_word_encode():
     expected_word = 'foo'
     result_word = InvertedIndex().encode_string(expected_word)
@@ -108,17 +354,63 @@ def test_encode_dict():
 def test_dict_encode_decode():
     expected_dict = {'word': {1, 23, 55}}
     foo_index = InvertedIndex()
-    result_dict = foo_index.decode_dict(foo_index.encode_dict(expected_dict))
+    result_dict = postings_as_sets(foo_index.decode_dict(foo_index.encode_dict(expected_dict)))
     assert expected_dict == result_dict, 'wrong decode/encode dict to binary string'
 
 
 def test_dict_encode_decode_multi_word():
     expected_dict = {'word': {1, 23, 55}, 'another': {1}}
     foo_index = InvertedIndex()
-    result_dict = foo_index.decode_dict(foo_index.encode_dict(expected_dict))
+    result_dict = postings_as_sets(foo_index.decode_dict(foo_index.encode_dict(expected_dict)))
     assert expected_dict == result_dict, 'wrong decode/encode dict to binary string'
 
 
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 65535, 65536, 2 ** 40])
+def test_varint_encode_decode(value):
+    bin_str = encode_varint(value)
+    assert (value, len(bin_str)) == decode_varint(bin_str, 0), 'wrong decode/encode varint to binary string'
+
+
+@pytest.mark.parametrize('values', [[], [1, 2, 127], [0, 128, 3, 65536, 2 ** 32 - 1]])
+def test_varints_encode_decode(values):
+    bin_str = b''.join(map(encode_varint, values)) + b'tail'
+    result, read_bytes = decode_varints(bin_str, 0, len(values))
+    assert array('I', values) == result, 'wrong decode/encode varints block'
+    assert len(bin_str) - len(b'tail') == read_bytes, 'wrong size of decoded varints block'
+
+
+def test_varint_encode_negative_value():
+    with pytest.raises(ValueError):
+        encode_varint(-1)
+
+
+@pytest.mark.parametrize('docs_set', [set(), {0}, {1, 2, 300}, {5, 70000, 2 ** 32 - 1}])
+def test_postings_encode_decode(docs_set):
+    bin_str = InvertedIndex.encode_postings(docs_set)
+    result, read_bytes = InvertedIndex.decode_postings(bin_str + b'tail', 0)
+    assert array('I', sorted(docs_set)) == result, 'wrong decode/encode postings to binary string'
+    assert len(bin_str) == read_bytes, 'wrong size of decoded postings'
+
+
+def test_postings_encode_doc_id_out_of_range():
+    with pytest.raises(ValueError):
+        InvertedIndex.encode_postings({2 ** 32})
+
+
+def test_dict_encode_decode_large_doc_ids():
+    expected_dict = {'word': {1, 65535, 65536, 10 ** 9}, 'another': {70000}}
+    foo_index = InvertedIndex()
+    result_dict = postings_as_sets(foo_index.decode_dict(foo_index.encode_dict(expected_dict)))
+    assert expected_dict == result_dict, 'wrong decode/encode dict with doc ids out of unsigned short'
+
+
+def test_decode_short_postings_dict():
+    entry = InvertedIndex.encode_string('word') + struct.pack('>HHH', 2, 1, 23)
+    bin_str = struct.pack('>4sB', b'INVX', 1) + entry + struct.pack('>QIQ', 5, 1, 5 + len(entry))
+    result_dict = postings_as_sets(InvertedIndex().decode_dict(bin_str))
+    assert {'word': {1, 23}} == result_dict, 'wrong decode of index with unsigned short postings'
+
+
 def test_load_value_is_file_descriptor():
     with pytest.raises(ValueError):
         InvertedIndex().load(fd=2)
@@ -137,7 +429,35 @@ def test_dump_load_small_index():
         index.dump(fd)
     with open(small_index_path, 'rb') as fd:
         index.load(fd)
-    assert index.inverted_index == _SMALL_INDEX, 'dumped and loaded index not the same'
+    assert postings_as_sets(index.inverted_index) == _SMALL_INDEX, 'dumped and loaded index not the same'
+    assert isinstance(index.inverted_index['word'], array), 'loaded postings are not an array'
+
+
+def test_load_small_index_is_mapped():
+    index = InvertedIndex()
+    index.inverted_index = _SMALL_INDEX
+    small_index_path = 'small.index'
+    with open(small_index_path, 'wb') as fd:
+        index.dump(fd)
+    with open(small_index_path, 'rb') as fd:
+        index.load(fd)
+    assert isinstance(index.inverted_index, MappedIndex), 'loaded index is not memory mapped'
+    assert list(index.inverted_index) == sorted(_SMALL_INDEX), 'terms in dumped index are not sorted'
+    assert 'foobar' not in index.inverted_index, 'find a word, that not in index'
+    assert index.query(['word', 'foobar']) == set(), 'find a doc, that not in index'
+
+
+def test_decode_varint_postings_dict():
+    entry = InvertedIndex.encode_string('word') + encode_varint(2) + encode_varint(1) + encode_varint(300)
+    bin_str = struct.pack('>4sB', b'INVX', 2) + entry + struct.pack('>QIQ', 5, 1, 5 + len(entry))
+    result_dict = postings_as_sets(InvertedIndex().decode_dict(bin_str))
+    assert {'word': {1, 301}} == result_dict, 'wrong decode of index with varint postings'
+
+
+def test_decode_legacy_dict():
+    bin_str = struct.pack('>i', 1) + InvertedIndex.encode_string('word') + struct.pack('>HHH', 2, 1, 23)
+    result_dict = InvertedIndex().decode_dict(bin_str)
+    assert {'word': {1, 23}} == result_dict, 'wrong decode of index in legacy format'
 
 
 def test_parse_queries_wrong_fd():
@@ -199,6 +519,232 @@ def test_unicode_query_two_docs_in_index():
     assert index.query(['один', 'два']) == {1, 2}, 'didnt find a two docs, which are present in index with unicode'
 
 
+@pytest.mark.parametrize('doc_id, low, expected_ind', [
+    (1, 0, 0), (7, 0, 3), (8, 0, 4), (100, 0, 9), (101, 0, 10), (50, 5, 8), (2, 4, 4),
+])
+def test_gallop_search(doc_id, low, expected_ind):
+    postings = array('I', [1, 2, 5, 7, 9, 11, 20, 40, 60, 100])
+    assert expected_ind == gallop_search(postings, doc_id, low), 'wrong insert position in postings'
+
+
+@pytest.mark.parametrize('short_postings, long_postings, expected', [
+    ([], [1, 2, 3], []),
+    ([2, 3], [1, 2, 3], [2, 3]),
+    ([4, 1000], list(range(0, 2000, 2)), [4, 1000]),
+    ([1, 999, 5000], list(range(0, 2000, 2)), []),
+])
+def test_intersect_postings(short_postings, long_postings, expected):
+    result = intersect_postings(array('I', short_postings), array('I', long_postings))
+    assert array('I', expected) == result, 'wrong intersection of postings'
+
+
+def test_query_words_order():
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1}, 'foobar': {1, 2}})
+    assert index.query(['foo', 'foobar', 'bar']) == index.query(['bar', 'foobar', 'foo', 'bar']) == {1}, (
+        'query result depends on words order')
+
+
+def test_query_loaded_index():
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1}, 'foobar': {1, 2}})
+    index.inverted_index = index.decode_dict(index.encode_dict(index.inverted_index))
+    assert index.query(['foo', 'foobar']) == {1, 2}, 'didnt find a two docs, which are present in loaded index'
+    assert index.query(['foo', 'baz']) == set(), 'find a doc, that not in loaded index'
+
+
+def test_query_cache_lru_eviction():
+    cache = QueryCache(max_size=2)
+    cache.put(('foo',), array('I', [1]))
+    cache.put(('bar',), array('I', [2]))
+    assert array('I', [1]) == cache.get(('foo',)), 'didnt find cached result'
+    cache.put(('baz',), array('I', [3]))
+    assert cache.get(('bar',)) is None, 'least recently used result was not evicted'
+    assert (1, 1) == (cache.hits, cache.misses), 'wrong cache hits and misses counters'
+
+
+def test_query_with_cache():
+    index = InvertedIndex(cache_size=10)
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1, 2}, 'foobar': {1, 2, 4}})
+    assert index.query(['foo', 'bar', 'foobar']) == {1, 2}, 'didnt find docs with cached query'
+    assert index.query(['foobar', 'foo', 'bar', 'foo']) == {1, 2}, 'didnt find docs with cached query'
+    assert index.cache.hits == 1, 'normalized query was not taken from cache'
+    assert index.query(['bar', 'foo']) == {1, 2}, 'didnt find docs with cached pair of words'
+    assert index.cache.hits == 2, 'intersection of rarest pair of words was not cached'
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 100])
+def test_run_batch_same_as_find_articles(batch_size):
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1, 2}, 'foobar': {1, 2, 4}})
+    index.inverted_index = index.decode_dict(index.encode_dict(index.inverted_index))
+    queries = [['foo', 'bar', 'foobar'], [], ['baz'], ['foobar', 'foo'], ['bar', 'foobar', 'foo', 'bar']]
+    expected = [index.find_articles(words) for words in queries]
+    assert expected == list(index.run_batch(queries, batch_size)), 'batch answers differ from find_articles'
+
+
+def test_dict_encode_decode_many_blocks():
+    expected_dict = {f'word_{word_ind:03}': {word_ind, word_ind + 1000} for word_ind in range(100)}
+    expected_dict['long_' + 'x' * 1000] = {7}
+    foo_index = InvertedIndex()
+    result_index = foo_index.decode_dict(foo_index.encode_dict(expected_dict))
+    assert sorted(expected_dict) == list(result_index), 'wrong terms order in front coded dictionary'
+    assert expected_dict == postings_as_sets(result_index), 'wrong decode/encode dict with many blocks'
+    assert 'word_100' not in result_index and 'a' not in result_index and 'z' not in result_index, (
+        'find a word, that not in front coded dictionary')
+
+
+def test_mapped_index_caches_visited_block_heads():
+    expected_dict = {f'word_{word_ind:04}': {word_ind} for word_ind in range(1600)}
+    result_index = InvertedIndex().decode_dict(InvertedIndex().encode_dict(expected_dict))
+    assert {777} == set(result_index['word_0777']), 'wrong postings found by bisection of block heads'
+    visited_heads = dict(result_index._block_heads)
+    assert 0 < len(visited_heads) <= 8, 'block heads were not read on demand by bisection of 100 blocks'
+    assert {777} == set(result_index['word_0777']) and visited_heads == result_index._block_heads, (
+        'repeated lookup did not reuse sparse index of block heads')
+
+
+@pytest.mark.parametrize('loaded', [False, True])
+def test_prefix_query(loaded):
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'optimal': {1, 2}, 'optimize': {2, 3}, 'optim': {4},
+                                             'option': {5}, 'bar': {2, 3, 4}})
+    if loaded:
+        index.inverted_index = index.decode_dict(index.encode_dict(index.inverted_index))
+    assert {1, 2, 3, 4} == index.query(['optim*']), 'didnt find docs with words of prefix'
+    assert {2, 3, 4} == index.query(['optim*', 'bar']), 'didnt find docs with words of prefix and another word'
+    assert {5} == index.query(['optio*']), 'didnt find docs with the only word of prefix'
+    assert set() == index.query(['foo*']), 'find a doc with prefix, that not in index'
+    assert set() == index.query(['*']), 'wildcard without prefix matches words'
+
+
+def test_prefix_query_normalized():
+    index = InvertedIndex(tokenizer=Tokenizer(lowercase=True, strip_punctuation=True))
+    index.add_new_document(1, 'Optimization, matters')
+    assert {1} == index.query(['OPTIM*']), 'prefix of query was not normalized'
+
+
+@pytest.mark.parametrize('top_k', [1, 2, 3, 10])
+@pytest.mark.parametrize('query', [['foo'], ['foo', 'bar'], ['bar', 'baz', 'qux'], ['qux', 'foo', 'missing']])
+def test_rank_same_as_exhaustive_bm25(tmp_path, query, top_k):
+    index = build_ranked_index(_RANKED_DOCS)
+    expected = rank_exhaustive(index.inverted_index, query, top_k)
+    assert same_ranking(expected, index.rank(query, top_k)), 'wrong ranking of built index'
+
+    index_path = tmp_path / 'ranked.index'
+    with open(index_path, 'wb') as fd:
+        index.dump(fd)
+    loaded_index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        loaded_index.load(fd)
+    assert loaded_index.frequencies, 'frequencies flag was not loaded from index'
+    assert same_ranking(expected, loaded_index.rank(query, top_k)), 'wrong ranking of loaded index'
+    assert loaded_index.query(query) == index.query(query), 'ranked index answers boolean queries differently'
+
+
+def test_rank_many_docs_with_early_termination():
+    rnd = random.Random(0)
+    words = [f'w{word_ind}' for word_ind in range(50)]
+    weights = [1 / (word_ind + 1) for word_ind in range(50)]
+    docs = [f'{doc_id} ' + ' '.join(rnd.choices(words, weights, k=rnd.randint(1, 30))) for doc_id in range(2000)]
+    index = build_ranked_index(docs)
+    for query in (['w0', 'w1', 'w40'], ['w0', 'w2', 'w3', 'w4', 'w5'], ['w49']):
+        expected = rank_exhaustive(index.inverted_index, query, 10)
+        assert same_ranking(expected, index.rank(query, 10)), f'wrong top docs of query {query}'
+    assert '' == index.find_top_articles(['missing'], 10), 'find a doc with word, that not in index'
+
+
+def test_rank_without_frequencies():
+    index = InvertedIndex()
+    index.add_new_document(1, 'foo')
+    with pytest.raises(ValueError):
+        index.rank(['foo'], 10)
+
+
+def test_ranked_index_external_and_parallel_build(tmp_path):
+    dataset_path = tmp_path / 'ranked.txt'
+    dataset_path.write_text('\n'.join(_RANKED_DOCS) + '\n')
+    dumps = []
+    for workers in (1, 2):
+        index = InvertedIndex(frequencies=True)
+        with open(dataset_path, 'r') as fd:
+            index.build(fd, workers=workers)
+        output = BytesIO()
+        index.dump(output)
+        dumps.append(output.getvalue())
+    for memory_limit in (1, 10 ** 9):
+        output = BytesIO()
+        with open(dataset_path, 'r') as fd:
+            InvertedIndex(frequencies=True).build_external(fd, output, memory_limit)
+        dumps.append(output.getvalue())
+    assert all(dumps[0] == bin_str for bin_str in dumps), 'ranked index builds differ'
+
+
+def test_ranked_index_segments(tmp_path):
+    index_path = str(tmp_path / 'ranked.index')
+    with open(index_path, 'wb') as fd:
+        build_ranked_index(_RANKED_DOCS[:3]).dump(fd)
+    dataset_path = tmp_path / 'new_docs.txt'
+    dataset_path.write_text('\n'.join(_RANKED_DOCS[3:]) + '\n')
+    with open(dataset_path, 'r') as fd:
+        InvertedIndex().append_segment(fd, index_path)
+    expected = build_ranked_index(_RANKED_DOCS).rank(['foo', 'qux'], 3)
+    segmented_index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        segmented_index.load(fd)
+    assert isinstance(segmented_index.inverted_index, SegmentedIndex), 'segments were not loaded'
+    assert same_ranking(expected, segmented_index.rank(['foo', 'qux'], 3)), 'wrong ranking of segments'
+
+    InvertedIndex().compact(index_path)
+    compacted_index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        compacted_index.load(fd)
+    assert same_ranking(expected, compacted_index.rank(['foo', 'qux'], 3)), 'wrong ranking of compacted index'
+
+
+def test_ranked_index_interrupted_compaction(tmp_path, monkeypatch):
+    index_path = str(tmp_path / 'ranked.index')
+    with open(index_path, 'wb') as fd:
+        build_ranked_index(_RANKED_DOCS[:3]).dump(fd)
+    for doc_ind in range(3, len(_RANKED_DOCS)):
+        dataset_path = tmp_path / f'new_docs_{doc_ind}.txt'
+        dataset_path.write_text(_RANKED_DOCS[doc_ind] + '\n')
+        with open(dataset_path, 'r') as fd:
+            InvertedIndex().append_segment(fd, index_path)
+    expected = build_ranked_index(_RANKED_DOCS).rank(['foo', 'qux'], 3)
+
+    def crash(path):
+        raise OSError(f'crashed before removing {path}')
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'remove', crash)
+        with pytest.raises(OSError):
+            InvertedIndex().compact(index_path)
+    assert list_segment_paths(index_path) == [], 'merged segments are listed after compaction replaced index'
+    interrupted_index = InvertedIndex()
+    with open(index_path, 'rb') as fd:
+        interrupted_index.load(fd)
+    assert same_ranking(expected, interrupted_index.rank(['foo', 'qux'], 3)), 'merged segments are counted twice'
+
+    InvertedIndex().compact(index_path)
+    assert ['ranked.index'] == sorted(path.name for path in tmp_path.iterdir() if path.name.startswith('ranked')), (
+        'interrupted compaction was not finished')
+
+
+def test_query_top_k_cli_needs_frequencies(tmp_path):
+    index_path = str(tmp_path / 'plain.index')
+    index = InvertedIndex()
+    for document in _RANKED_DOCS:
+        doc_id, content = document.split(maxsplit=1)
+        index.add_new_document(int(doc_id), content)
+    with open(index_path, 'wb') as fd:
+        index.dump(fd)
+    completed = subprocess.run([sys.executable, 'inverted_index.py', 'query', '-i', index_path, '-q', 'foo',
+                                '--top-k', '3'], capture_output=True, text=True)
+    assert 2 == completed.returncode, 'ranked query of index without frequencies did not fail as usage error'
+    assert 'requires inverted index built with --frequencies' in completed.stderr, 'wrong error message'
+    assert 'Traceback' not in completed.stderr, 'error was not reported by parser'
+
+
 def test_one_article():
     index = InvertedIndex()
     with open(ONE_ARTICLE_PATH, 'r') as fd:
@@ -230,3 +776,39 @@ def test_many_queries_not_in_one_article(query):
     with open(ONE_ARTICLE_PATH, 'r') as fd:
         index.build(fd)
     assert article_id not in index.find_articles(query), 'find article in query that not in one article'
+
+
+def test_serve_stdio_same_as_find_articles():
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1}, 'foobar': {1, 2}})
+    queries = ['foo foobar', 'bar', 'baz', '']
+    output_fd, latency_fd = StringIO(), StringIO()
+    QueryServer(index, latency_fd).serve_stdio(StringIO('\n'.join(queries) + '\n'), output_fd)
+    expected = [index.find_articles(query.split()) for query in queries]
+    assert expected == output_fd.getvalue().splitlines(), 'served answers differ from find_articles'
+    assert len(queries) == len(latency_fd.getvalue().splitlines()), 'latency is not reported for every query'
+
+
+def test_serve_tcp_many_clients():
+    index = InvertedIndex()
+    index.inverted_index = defaultdict(set, {'foo': {1, 2, 3}, 'bar': {1}, 'слово': {2}})
+    query_server = QueryServer(index, StringIO())
+
+    async def ask(port, queries):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        answers = []
+        for query in queries:
+            writer.write(query.encode() + b'\n')
+            await writer.drain()
+            answers.append((await reader.readline()).decode().rstrip('\n'))
+        writer.close()
+        return answers
+
+    async def run_clients():
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            server = await query_server.start_tcp('127.0.0.1', 0, executor)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                return await asyncio.gather(ask(port, ['foo bar', 'слово']), ask(port, ['foo', 'baz']))
+
+    assert [['1', '2'], ['1,2,3', '']] == asyncio.run(run_clients()), 'wrong answers from tcp query server'
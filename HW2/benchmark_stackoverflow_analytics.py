@@ -0,0 +1,162 @@
+import re
+import sys
+import time
+import random
+import timeit
+import tracemalloc
+from argparse import ArgumentParser
+from itertools import accumulate
+
+from stackoverflow_analytics import WordStatistic, CompactWordStatistic, select_top_words
+
+_BYTES_IN_MEGABYTE = 1024 * 1024
+
+
+def generate_scores(vocabulary_size, seed):
+    rnd = random.Random(seed)
+    scores = [int(rnd.paretovariate(1.2)) - rnd.randint(0, 3) for _ in range(vocabulary_size)]
+    word_ids = [word_id for word_id in range(vocabulary_size) if rnd.random() < 0.8]
+    return scores, word_ids
+
+
+def select_top_words_by_sort(scores, word_ids, top_n):
+    return sorted(word_ids, key=lambda word_id: (-scores[word_id], word_id))[:top_n]
+
+
+def run_selection_benchmark(args):
+    print(f'{"vocabulary":>10} {"top_n":>6} {"sort, ms":>10} {"select, ms":>11} {"speedup":>8}')
+    for vocabulary_size in args.vocabulary_sizes:
+        scores, word_ids = generate_scores(vocabulary_size, args.seed)
+        for top_n in args.top_n:
+            if select_top_words_by_sort(scores, word_ids, top_n) != select_top_words(scores, word_ids, top_n):
+                raise ValueError(f'selection differs from sort for vocabulary {vocabulary_size}, top {top_n}')
+            sort_time = timeit.timeit(lambda: select_top_words_by_sort(scores, word_ids, top_n),
+                                      number=args.repeat) / args.repeat
+            select_time = timeit.timeit(lambda: select_top_words(scores, word_ids, top_n),
+                                        number=args.repeat) / args.repeat
+            print(f'{vocabulary_size:>10} {top_n:>6} {sort_time * 1000:>10.3f} {select_time * 1000:>11.3f} '
+                  f'{sort_time / select_time:>7.2f}x')
+
+
+def generate_documents(documents_count, vocabulary_size, title_length, seed):
+    rnd = random.Random(seed)
+    vocabulary = [f'word{word_ind}' for word_ind in range(vocabulary_size)]
+    cum_weights = list(accumulate(1 / rank for rank in range(1, vocabulary_size + 1)))
+    return [(rnd.randint(2008, 2020), rnd.randint(-5, 100),
+             ' '.join(rnd.choices(vocabulary, cum_weights=cum_weights, k=title_length)))
+            for _ in range(documents_count)]
+
+
+def run_memory_benchmark(args):
+    documents = generate_documents(args.documents, args.vocabulary, args.title_length, args.seed)
+    queries = [(2008, 2020, 10), (2010, 2012, 50), (2015, 2015, 10)]
+    answers = []
+    print(f'{"statistic":>21} {"memory, MB":>11} {"build, s":>9} {"queries, s":>11}')
+    for statistic_class in (WordStatistic, CompactWordStatistic):
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        statistic = statistic_class()
+        for doc_year, doc_score, doc_text in documents:
+            statistic.add_new_document_to_statistic(doc_year, doc_score, doc_text)
+        build_time = time.perf_counter() - start_time
+        memory_usage = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start_time = time.perf_counter()
+        answers.append(statistic.calculate_statistics(queries))
+        queries_time = time.perf_counter() - start_time
+        print(f'{statistic_class.__name__:>21} {memory_usage / _BYTES_IN_MEGABYTE:>11.1f} {build_time:>9.2f} '
+              f'{queries_time:>11.2f}')
+    if answers[0] != answers[1]:
+        raise ValueError('compact statistic answers differ')
+
+
+def legacy_document_words(doc_text, stop_words):
+    return [word for word in set(re.findall(r'\w+', doc_text.lower())) if word not in stop_words]
+
+
+def generate_titles(titles_count, vocabulary_size, title_length, repeated, seed):
+    """Generated titles, fraction repeated of them repeats earlier ones."""
+    rnd = random.Random(seed)
+    titles = [doc_text for _, _, doc_text in generate_documents(titles_count, vocabulary_size, title_length, seed)]
+    for title_ind in range(1, titles_count):
+        if rnd.random() < repeated:
+            titles[title_ind] = titles[rnd.randrange(title_ind)]
+    return titles
+
+
+def run_tokenize_benchmark(args):
+    titles = generate_titles(args.titles, args.vocabulary, args.title_length, args.repeated, args.seed)
+    stop_words = [f'word{word_ind}' for word_ind in range(args.stop_words)]
+    legacy_stop_words = set(stop_words)
+    statistic = WordStatistic()
+    statistic.load_stop_words(stop_words)
+    cached_statistic = WordStatistic(args.cache_size)
+    cached_statistic.load_stop_words(stop_words)
+    expected_words = [set(legacy_document_words(doc_text, legacy_stop_words)) for doc_text in titles]
+    runs = [
+        ('legacy', lambda: [legacy_document_words(doc_text, legacy_stop_words) for doc_text in titles]),
+        ('document_words', lambda: [statistic.document_words(doc_text) for doc_text in titles]),
+        ('documents_words', lambda: statistic.documents_words(titles)),
+        ('documents_words cached', lambda: cached_statistic.documents_words(titles)),
+    ]
+    print(f'{"tokenization":>22} {"titles/s":>10} {"speedup":>8}')
+    legacy_time = None
+    for name, run in runs:
+        if list(map(set, run())) != expected_words:
+            raise ValueError(f'{name} tokenization differs from legacy one')
+        # every timed run starts with empty cache, hits come only from titles repeated within the run
+        run_time = sum(timeit.repeat(run, setup=cached_statistic.tokenize_title.cache_clear, repeat=args.repeat,
+                                     number=1)) / args.repeat
+        legacy_time = legacy_time or run_time
+        print(f'{name:>22} {len(titles) / run_time:>10.0f} {legacy_time / run_time:>7.2f}x')
+
+
+def setup_parser(arg_parser):
+    sub_parsers = arg_parser.add_subparsers(help='choose benchmark')
+    selection_parser = sub_parsers.add_parser(
+        'selection',
+        help='compare full sort and partial top-n selection of words over growing vocabulary',
+    )
+    selection_parser.add_argument('--vocabulary-sizes', help='numbers of words with scores', type=int, nargs='+',
+                                  default=[1000, 10000, 100000, 1000000])
+    selection_parser.add_argument('--top-n', help='sizes of selected top', type=int, nargs='+', default=[10, 50])
+    selection_parser.add_argument('--repeat', help='number of selections to average', type=int, default=5)
+    selection_parser.add_argument('--seed', help='random seed for generated scores', type=int, default=0)
+    selection_parser.set_defaults(handler=run_selection_benchmark)
+    memory_parser = sub_parsers.add_parser(
+        'memory',
+        help='compare memory of dict and compact word statistic built from generated titles',
+    )
+    memory_parser.add_argument('--documents', help='number of generated titles', type=int, default=200000)
+    memory_parser.add_argument('--vocabulary', help='number of distinct words', type=int, default=100000)
+    memory_parser.add_argument('--title-length', help='number of words in title', type=int, default=8)
+    memory_parser.add_argument('--seed', help='random seed for generated titles', type=int, default=0)
+    memory_parser.set_defaults(handler=run_memory_benchmark)
+    tokenize_parser = sub_parsers.add_parser(
+        'tokenize',
+        help='compare legacy per title tokenization with batched and cached tokenization of generated titles',
+    )
+    tokenize_parser.add_argument('--titles', help='number of generated titles', type=int, default=200000)
+    tokenize_parser.add_argument('--vocabulary', help='number of distinct words', type=int, default=100000)
+    tokenize_parser.add_argument('--title-length', help='number of words in title', type=int, default=8)
+    tokenize_parser.add_argument('--stop-words', help='number of most frequent words used as stop words', type=int,
+                                 default=100)
+    tokenize_parser.add_argument('--repeated', help='fraction of titles repeating earlier ones', type=float,
+                                 default=0.1)
+    tokenize_parser.add_argument('--cache-size', help='number of cached tokenizations', type=int, default=65536)
+    tokenize_parser.add_argument('--repeat', help='number of tokenizations to average', type=int, default=3)
+    tokenize_parser.add_argument('--seed', help='random seed for generated titles', type=int, default=0)
+    tokenize_parser.set_defaults(handler=run_tokenize_benchmark)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        prog='benchmark_stackoverflow_analytics',
+        description='benchmarks of word statistic',
+    )
+    setup_parser(parser)
+    arguments = parser.parse_args()
+    if not hasattr(arguments, 'handler'):
+        parser.print_help()
+        sys.exit(1)
+    arguments.handler(arguments)
@@ -1,34 +1,420 @@
+import io
+import os
 import sys
 import re
+import bz2
+import gzip
+import mmap
+import time
+import queue
+import threading
+import heapq
+import struct
+import operator
 import logging
 import logging.config
+from concurrent.futures import ProcessPoolExecutor
 
 import json
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate, compress, islice
 from collections import defaultdict
-from argparse import ArgumentParser, FileType
+from collections.abc import Mapping, Sequence
+from argparse import ArgumentParser, ArgumentTypeError, FileType
 
 from lxml import etree
 import yaml
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOGGING_CONFIG_FILEPATH = 'logging_conf.yml'
+DEFAULT_SKETCH_SIZE = 10000
+SKETCH_HEAP_GROWTH = 4
+SNAPSHOT_MAGIC = b'SOWS'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER_FORMATS = {1: '<4sBBxxQQ', 2: '<4sBBxxQQQ'}
+SNAPSHOT_PREFIX_FORMAT = '<4sB'
+BYTE_ORDERS = ('little', 'big')
+WORD_RE = re.compile(r'\w+')
+POST_ID_RE = re.compile(rb'\sId="(\d+)"')
+DOCUMENTS_BATCH_SIZE = 1024
+COMPRESSION_MAGICS = {b'\x1f\x8b': 'gzip', b'BZh': 'bz2', b'\x28\xb5\x2f\xfd': 'zstd'}
+DECOMPRESSION_BLOCK_SIZE = 1024 * 1024
+DECOMPRESSION_QUEUE_SIZE = 16
+DECOMPRESSION_PUT_TIMEOUT = 0.1
+BYTES_IN_MEGABYTE = 1024 * 1024
 logger = logging.getLogger('stackoverflow_analytics')
 
 
+class DecompressedReader(io.RawIOBase):
+    """Raw stream of decompressed data, blocks are decompressed ahead of reader by background thread.
+
+    bz2, zlib and zstandard release GIL while decompressing, so decompression overlaps with XML parsing.
+    """
+
+    def __init__(self, fd, compressed_fd, compression):
+        super().__init__()
+        self.fd = fd
+        self.compressed_fd = compressed_fd
+        self.compression = compression
+        self.blocks = queue.Queue(maxsize=DECOMPRESSION_QUEUE_SIZE)
+        self.block = memoryview(b'')
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.decompress_blocks, daemon=True)
+        self.thread.start()
+
+    def decompress_blocks(self):
+        start_time = time.perf_counter()
+        decompressed_size = 0
+        try:
+            while not self.stopped.is_set() and (block := self.fd.read(DECOMPRESSION_BLOCK_SIZE)):
+                decompressed_size += len(block)
+                self.put_block(block)
+        except Exception as error:
+            # error is raised again by reading thread
+            self.put_block(error)
+            return
+        elapsed = time.perf_counter() - start_time
+        compressed_size = os.fstat(self.compressed_fd.fileno()).st_size
+        logger.info('decompress %s dataset of %.1f MB into %.1f MB in %.2f s, %.1f MB/s'
+                    % (self.compression, compressed_size / BYTES_IN_MEGABYTE,
+                       decompressed_size / BYTES_IN_MEGABYTE, elapsed,
+                       decompressed_size / BYTES_IN_MEGABYTE / max(elapsed, sys.float_info.epsilon)))
+        self.put_block(None)
+
+    def put_block(self, block):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=DECOMPRESSION_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.block:
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is None:
+                self.finished = True
+            elif isinstance(block, Exception):
+                self.finished = True
+                raise block
+            else:
+                self.block = memoryview(block)
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.fd.close()
+            self.compressed_fd.close()
+        super().close()
+
+
+def open_questions(path, encoding='utf-8'):
+    """Text stream of questions dataset, gzip, bz2 and zstd datasets are detected by magic bytes."""
+    fd = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    magic = fd.peek(max(map(len, COMPRESSION_MAGICS)))
+    compression = next((compression for compression_magic, compression in COMPRESSION_MAGICS.items()
+                        if magic.startswith(compression_magic)), None)
+    if compression is None:
+        return io.TextIOWrapper(fd, encoding=encoding)
+    if compression == 'gzip':
+        decompressed_fd = gzip.open(fd)
+    elif compression == 'bz2':
+        decompressed_fd = bz2.open(fd)
+    elif zstandard is not None:
+        decompressed_fd = zstandard.ZstdDecompressor().stream_reader(fd, read_across_frames=True)
+    else:
+        fd.close()
+        raise ImportError('zstandard package is required to read zstd compressed questions dataset')
+    return io.TextIOWrapper(io.BufferedReader(DecompressedReader(decompressed_fd, fd, compression)),
+                            encoding=encoding)
+
+
+def questions_file(path):
+    try:
+        return open_questions(path)
+    except (OSError, ImportError) as error:
+        raise ArgumentTypeError(f"can't open '{path}': {error}")
+
+
+def split_file_chunks(path, chunks_count, start=0):
+    file_size = os.path.getsize(path)
+    bounds = [start]
+    with open(path, 'rb') as fd:
+        for chunk_ind in range(1, chunks_count):
+            fd.seek(max(start + (file_size - start) * chunk_ind // chunks_count, bounds[-1]))
+            fd.readline()
+            bounds.append(fd.tell())
+    bounds.append(file_size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def iter_chunk_lines(path, start, end, encoding):
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        position = start
+        while position < end:
+            line = fd.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+
+def next_row_post_id(fd, position):
+    """Start and post Id of first row with Id starting at or after position, end of file and None if none."""
+    fd.seek(max(position - 1, 0))
+    if position:
+        fd.readline()
+    line_start = fd.tell()
+    for line in fd:
+        match = POST_ID_RE.search(line)
+        if match:
+            return line_start, int(match[1])
+        line_start += len(line)
+    return line_start, None
+
+
+def find_new_posts_offset(path, last_post_id):
+    """Start of first row with post Id greater than last_post_id, found by bisection of rows ordered by Id."""
+    with open(path, 'rb') as fd:
+        low, high = 0, os.path.getsize(path)
+        while low < high:
+            middle = (low + high) // 2
+            _, post_id = next_row_post_id(fd, middle)
+            if post_id is None or post_id > last_post_id:
+                high = middle
+            else:
+                low = middle + 1
+        return next_row_post_id(fd, low)[0]
+
+
+def build_chunk_statistic(path, start, end, encoding, stop_words, last_post_id):
+    statistic = WordStatistic()
+    statistic.stop_words = stop_words
+    statistic.last_post_id = last_post_id
+    documents_count = statistic.load_documents(iter_chunk_lines(path, start, end, encoding),
+                                               ingest=last_post_id > 0)
+    return ({year: dict(year_dict) for year, year_dict in statistic.words_statistic.items()}, documents_count,
+            statistic.last_post_id)
+
+
+def tokenize_title(doc_text, stop_words):
+    """Distinct lowercase words of title except stop words."""
+    return frozenset(WORD_RE.findall(doc_text.lower())).difference(stop_words)
+
+
+def select_top_words(scores, word_ids, top_n):
+    """Ids of top_n words ordered by descending score and ascending id, without sorting all words."""
+    if top_n <= 0 or len(word_ids) <= top_n:
+        return sorted(word_ids, key=scores.__getitem__, reverse=True)[:top_n]
+    word_scores = list(map(scores.__getitem__, word_ids))
+    threshold = heapq.nlargest(top_n, word_scores)[-1]
+    candidates = compress(word_ids, map(threshold.__le__, word_scores))
+    # stable sort keeps ascending word ids, hence words, among equal scores
+    return sorted(candidates, key=scores.__getitem__, reverse=True)[:top_n]
+
+
+def read_snapshot_array(bin_view, start_ind, typecode, count, byte_order):
+    values = array(typecode)
+    end_ind = start_ind + count * values.itemsize
+    if byte_order == sys.byteorder:
+        return bin_view[start_ind:end_ind].cast(typecode), end_ind
+    values.frombytes(bin_view[start_ind:end_ind])
+    values.byteswap()
+    return values, end_ind
+
+
+class SnapshotVocabulary(Sequence):
+    """Words of snapshot decoded on access from utf-8 blob by offsets."""
+
+    def __init__(self, offsets, words_blob):
+        self.offsets = offsets
+        self.words_blob = words_blob
+
+    def __getitem__(self, word_id):
+        return bytes(self.words_blob[self.offsets[word_id]:self.offsets[word_id + 1]]).decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class YearPrefixSums:
+    """Cumulative scores and presence counts of words by year, word ids follow sorted vocabulary.
+
+    Snapshot is a '<4sBBxxQQQ' header of magic, version, byte order, years count,
+    vocabulary size and last ingested post Id followed by native ordered arrays:
+    years, word offsets, score sums and presence count sums of every year prefix,
+    then utf-8 words. Version 1 header has no post Id. Loaded arrays are views of
+    the mapped snapshot.
+    """
+
+    def __init__(self, years, vocabulary, score_sums, count_sums, from_snapshot=False, last_post_id=0):
+        self.years = years
+        self.vocabulary = vocabulary
+        self.score_sums = score_sums
+        self.count_sums = count_sums
+        self.from_snapshot = from_snapshot
+        self.last_post_id = last_post_id
+
+    @classmethod
+    def from_statistic(cls, words_statistic):
+        years = sorted(words_statistic)
+        vocabulary = sorted(set().union(*words_statistic.values()))
+        word_ids = {word: word_id for word_id, word in enumerate(vocabulary)}
+        scores = array('q', bytes(8 * len(vocabulary)))
+        counts = array('I', bytes(4 * len(vocabulary)))
+        score_sums = [scores]
+        count_sums = [counts]
+        for year in years:
+            scores = array('q', scores)
+            counts = array('I', counts)
+            for word, word_score in words_statistic[year].items():
+                word_id = word_ids[word]
+                scores[word_id] += word_score
+                counts[word_id] += 1
+            score_sums.append(scores)
+            count_sums.append(counts)
+        return cls(years, vocabulary, score_sums, count_sums)
+
+    @classmethod
+    def load(cls, bin_str):
+        magic, version = struct.unpack_from(SNAPSHOT_PREFIX_FORMAT, bin_str, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('file is not a word statistic snapshot')
+        if version not in SNAPSHOT_HEADER_FORMATS:
+            raise ValueError(f'unsupported word statistic snapshot version {version}')
+        header = struct.unpack_from(SNAPSHOT_HEADER_FORMATS[version], bin_str, 0)
+        byte_order, years_count, vocabulary_size = header[2:5]
+        last_post_id = header[5] if version > 1 else 0
+        byte_order = BYTE_ORDERS[byte_order]
+        bin_view = memoryview(bin_str)
+        years, read_ind = read_snapshot_array(bin_view, struct.calcsize(SNAPSHOT_HEADER_FORMATS[version]), 'q',
+                                              years_count, byte_order)
+        offsets, read_ind = read_snapshot_array(bin_view, read_ind, 'Q', vocabulary_size + 1, byte_order)
+        score_sums = []
+        for _ in range(years_count + 1):
+            scores, read_ind = read_snapshot_array(bin_view, read_ind, 'q', vocabulary_size, byte_order)
+            score_sums.append(scores)
+        count_sums = []
+        for _ in range(years_count + 1):
+            counts, read_ind = read_snapshot_array(bin_view, read_ind, 'I', vocabulary_size, byte_order)
+            count_sums.append(counts)
+        vocabulary = SnapshotVocabulary(offsets, bin_view[read_ind:read_ind + offsets[-1]])
+        return cls(list(years), vocabulary, score_sums, count_sums, from_snapshot=True, last_post_id=last_post_id)
+
+    def dump(self, fd, last_post_id=0):
+        encoded_words = [word.encode() for word in self.vocabulary]
+        fd.write(struct.pack(SNAPSHOT_HEADER_FORMATS[SNAPSHOT_VERSION], SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                             BYTE_ORDERS.index(sys.byteorder), len(self.years), len(encoded_words), last_post_id))
+        fd.write(array('q', self.years).tobytes())
+        fd.write(array('Q', accumulate(map(len, encoded_words), initial=0)).tobytes())
+        for scores in self.score_sums:
+            fd.write(scores.tobytes())
+        for counts in self.count_sums:
+            fd.write(counts.tobytes())
+        fd.write(b''.join(encoded_words))
+
+    def iter_years_statistic(self):
+        for year_ind, year in enumerate(self.years):
+            scores = map(operator.sub, self.score_sums[year_ind + 1], self.score_sums[year_ind])
+            counts = map(operator.sub, self.count_sums[year_ind + 1], self.count_sums[year_ind])
+            yield year, {self.vocabulary[word_id]: word_score
+                         for word_id, (word_score, word_count) in enumerate(zip(scores, counts)) if word_count}
+
+    def range_scores(self, start_year, end_year):
+        """Scores of all words over years range and ids of words found in the range."""
+        start_ind = bisect_left(self.years, start_year)
+        end_ind = max(bisect_right(self.years, end_year), start_ind)
+        scores = list(map(operator.sub, self.score_sums[end_ind], self.score_sums[start_ind]))
+        word_ids = list(compress(range(len(self.vocabulary)),
+                                 map(operator.sub, self.count_sums[end_ind], self.count_sums[start_ind])))
+        return scores, word_ids
+
+    def top_words(self, start_year, end_year, top_n):
+        scores, word_ids = self.range_scores(start_year, end_year)
+        top_ids = select_top_words(scores, word_ids, top_n)
+        return len(word_ids), [(self.vocabulary[word_id], scores[word_id]) for word_id in top_ids]
+
+
 class WordStatistic:
-    def __init__(self):
+    def __init__(self, tokens_cache_size=0):
         self.words_statistic = defaultdict(lambda: defaultdict(int))
-        self.stop_words = set()
+        self.stop_words = frozenset()
+        self.year_prefix_sums = None
+        self.last_post_id = 0
+        # frozen stop words are hashable, so repeated titles can be served from cache of tokenizations
+        self.tokenize_title = lru_cache(maxsize=tokens_cache_size)(tokenize_title) if tokens_cache_size \
+            else tokenize_title
+
+    def drop_year_prefix_sums(self):
+        year_prefix_sums, self.year_prefix_sums = self.year_prefix_sums, None
+        if year_prefix_sums is not None and year_prefix_sums.from_snapshot:
+            # statistic of loaded snapshot lives only in its prefix sums
+            self.merge_statistic(dict(year_prefix_sums.iter_years_statistic()))
+
+    def dump_snapshot(self, fd):
+        self.get_year_prefix_sums().dump(fd, self.last_post_id)
+
+    def save_snapshot(self, path):
+        """Dump snapshot into temporary file replacing path, so loaded snapshot at path stays intact until then."""
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as fd:
+                self.dump_snapshot(fd)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load_snapshot(self, fd):
+        try:
+            bin_str = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            bin_str = fd.read()
+        self.clear_statistic()
+        self.year_prefix_sums = YearPrefixSums.load(bin_str)
+        self.last_post_id = self.year_prefix_sums.last_post_id
+
+    def clear_statistic(self):
+        self.words_statistic.clear()
+        self.year_prefix_sums = None
+        self.last_post_id = 0
 
     def load_stop_words(self, fd):
-        for word in fd:
-            self.stop_words.add(word.strip())
+        self.stop_words = self.stop_words.union(word.strip() for word in fd)
 
     @staticmethod
-    def parse_documents(fd):
-        valid_documents = []
+    def iter_documents(fd):
+        for _, doc_year, doc_score, doc_text in WordStatistic.iter_posts(fd):
+            yield doc_year, doc_score, doc_text
+
+    @staticmethod
+    def iter_posts(fd):
+        """Post Id, year, score and title of valid questions, Id of rows without integer Id is 0."""
+        xml_parser = etree.XMLParser(resolve_entities=False)
         for line in fd:
+            # every valid question has Title attribute, answers and other rows are skipped unparsed
+            if 'Title' not in line:
+                continue
             try:
-                tag = etree.fromstring(line)
+                tag = etree.fromstring(line, xml_parser)
             except etree.XMLSyntaxError:
                 continue
             attributes = tag.attrib
@@ -41,15 +427,84 @@ class WordStatistic:
                     doc_score = int(attributes['Score'])
                 except ValueError:
                     continue
-                valid_documents.append((doc_year, doc_score, attributes['Title']))
-        return valid_documents
+                try:
+                    post_id = int(attributes['Id']) if 'Id' in attributes else 0
+                except ValueError:
+                    post_id = 0
+                yield post_id, doc_year, doc_score, attributes['Title']
+
+    @staticmethod
+    def parse_documents(fd):
+        return list(WordStatistic.iter_documents(fd))
+
+    def load_documents(self, fd, workers=1, ingest=False):
+        """Add questions of dataset, with ingest only questions with Id greater than last added one."""
+        if ingest and not self.last_post_id:
+            raise ValueError('statistic has no last post Id, ingest would add its questions again')
+        skip_post_id = self.last_post_id if ingest else 0
+        path = getattr(fd, 'name', None)
+        is_plain_file = isinstance(path, str) and os.path.isfile(path)
+        # plain dataset of rows ordered by Id is read from the first new row, other rows are skipped by Id
+        start = find_new_posts_offset(path, skip_post_id) if is_plain_file and skip_post_id else 0
+        if workers > 1 and is_plain_file:
+            return self.load_documents_parallel(path, fd.encoding, workers, start, skip_post_id)
+        if workers > 1:
+            logger.warning('questions dataset is not a plain file, it is parsed by single process')
+        if start:
+            fd = iter_chunk_lines(path, start, os.path.getsize(path), fd.encoding)
+        documents_count = 0
+        posts = self.iter_posts(fd)
+        if skip_post_id:
+            posts = (post for post in posts if post[0] > skip_post_id)
+        while posts_batch := list(islice(posts, DOCUMENTS_BATCH_SIZE)):
+            self.add_new_documents_to_statistic([post[1:] for post in posts_batch])
+            self.last_post_id = max(self.last_post_id, max(post[0] for post in posts_batch))
+            documents_count += len(posts_batch)
+        return documents_count
+
+    def load_documents_parallel(self, path, encoding, workers, start=0, skip_post_id=0):
+        documents_count = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build_chunk_statistic, path, chunk_start, chunk_end, encoding, self.stop_words,
+                                       skip_post_id)
+                       for chunk_start, chunk_end in split_file_chunks(path, workers, start)]
+            for future in futures:
+                words_statistic, chunk_documents_count, chunk_last_post_id = future.result()
+                self.merge_statistic(words_statistic)
+                self.last_post_id = max(self.last_post_id, chunk_last_post_id)
+                documents_count += chunk_documents_count
+        return documents_count
+
+    def merge_statistic(self, words_statistic):
+        if self.year_prefix_sums is not None:
+            self.drop_year_prefix_sums()
+        for year, year_statistic in words_statistic.items():
+            year_dict = self.words_statistic[year]
+            for word, word_score in year_statistic.items():
+                year_dict[word] += word_score
 
     def add_new_document_to_statistic(self, doc_year, doc_score, doc_text):
+        self.add_document_words(doc_year, doc_score, self.document_words(doc_text))
+
+    def add_new_documents_to_statistic(self, documents):
+        documents = list(documents)
+        documents_words = self.documents_words([doc_text for _, _, doc_text in documents])
+        for (doc_year, doc_score, _), doc_words in zip(documents, documents_words):
+            self.add_document_words(doc_year, doc_score, doc_words)
+
+    def add_document_words(self, doc_year, doc_score, doc_words):
+        if self.year_prefix_sums is not None:
+            self.drop_year_prefix_sums()
         year_dict = self.words_statistic[doc_year]
-        doc_words = set(re.findall(r'\w+', doc_text.lower()))
         for word in doc_words:
-            if word not in self.stop_words:
-                year_dict[word] += doc_score
+            year_dict[word] += doc_score
+
+    def document_words(self, doc_text):
+        return self.tokenize_title(doc_text, self.stop_words)
+
+    def documents_words(self, doc_texts):
+        tokenize, stop_words = self.tokenize_title, self.stop_words
+        return [tokenize(doc_text, stop_words) for doc_text in doc_texts]
 
     @staticmethod
     def parse_queries(fd):
@@ -62,25 +517,288 @@ class WordStatistic:
                 continue
         return valid_queries
 
+    def build_year_prefix_sums(self):
+        return YearPrefixSums.from_statistic(self.words_statistic)
+
+    def get_year_prefix_sums(self):
+        if self.year_prefix_sums is None:
+            self.year_prefix_sums = self.build_year_prefix_sums()
+        return self.year_prefix_sums
+
     def calculate_statistic(self, start_year, end_year, top_n):
         logger.debug('got query "%d,%d,%d"' % (start_year, end_year, top_n))
-        years_statistic = defaultdict(int)
-        for stat_year in range(start_year, end_year + 1):
-            for word, word_score in self.words_statistic[stat_year].items():
-                years_statistic[word] += word_score
+        words_count, top_n_words = self.get_year_prefix_sums().top_words(start_year, end_year, top_n)
+        return self.format_answer(start_year, end_year, top_n, words_count, top_n_words)
+
+    def calculate_statistics(self, queries):
+        """Answer queries like calculate_statistic, queries of the same years range share one top selection."""
+        ranges_top_n = defaultdict(int)
+        for start_year, end_year, top_n in queries:
+            ranges_top_n[start_year, end_year] = max(ranges_top_n[start_year, end_year], top_n)
+        ranges_top = {years_range: self.get_year_prefix_sums().top_words(*years_range, top_n)
+                      for years_range, top_n in ranges_top_n.items()}
+        answers = []
+        for start_year, end_year, top_n in queries:
+            if top_n < 0:
+                answers.append(self.calculate_statistic(start_year, end_year, top_n))
+                continue
+            logger.debug('got query "%d,%d,%d"' % (start_year, end_year, top_n))
+            words_count, top_words = ranges_top[start_year, end_year]
+            answers.append(self.format_answer(start_year, end_year, top_n, words_count, top_words[:top_n]))
+        return answers
 
-        if len(years_statistic) < top_n:
+    @staticmethod
+    def format_answer(start_year, end_year, top_n, words_count, top_n_words, bounds=None):
+        if words_count < top_n:
             logger.warning('not enough data to answer, found %d words out of %d for period "%d,%d"'
-                           % (len(years_statistic), top_n, start_year, end_year))
+                           % (words_count, top_n, start_year, end_year))
 
-        top_n_words = sorted(years_statistic.items(), key=lambda x: (-x[1], x[0]))[:top_n]
         answer_dict = {"start": start_year,
                        "end": end_year,
                        "top": top_n_words
                        }
+        if bounds is not None:
+            answer_dict["bounds"] = bounds
         return json.dumps(answer_dict)
 
 
+class CompactYearStatistic(Mapping):
+    """Read-only word to score view of one year of CompactWordStatistic."""
+
+    def __init__(self, statistic, year):
+        self.statistic = statistic
+        self.year = year
+
+    def __getitem__(self, word):
+        word_id = self.statistic.word_ids[word]
+        presence = self.statistic.year_presence[self.year]
+        if word_id >= len(presence) or not presence[word_id]:
+            raise KeyError(word)
+        return self.statistic.year_scores[self.year][word_id]
+
+    def __iter__(self):
+        presence = self.statistic.year_presence[self.year]
+        return map(self.statistic.words.__getitem__, compress(range(len(presence)), presence))
+
+    def __len__(self):
+        return self.statistic.year_presence[self.year].count(1)
+
+
+class CompactYearsStatistic(Mapping):
+    """Read-only year to CompactYearStatistic view of CompactWordStatistic."""
+
+    def __init__(self, statistic):
+        self.statistic = statistic
+
+    def __getitem__(self, year):
+        if year not in self.statistic.year_scores:
+            raise KeyError(year)
+        return CompactYearStatistic(self.statistic, year)
+
+    def __iter__(self):
+        return iter(self.statistic.year_scores)
+
+    def __len__(self):
+        return len(self.statistic.year_scores)
+
+
+class CompactWordStatistic(WordStatistic):
+    """Word statistic over interned word ids, every year keeps score and presence arrays indexed by word id.
+
+    words_statistic is a read-only mapping view of these arrays.
+    """
+
+    def __init__(self, tokens_cache_size=0):
+        super().__init__(tokens_cache_size)
+        self.word_ids = {}
+        self.words = []
+        self.year_scores = {}
+        self.year_presence = {}
+        self.words_statistic = CompactYearsStatistic(self)
+
+    def clear_statistic(self):
+        self.word_ids.clear()
+        self.words.clear()
+        self.year_scores.clear()
+        self.year_presence.clear()
+        self.year_prefix_sums = None
+        self.last_post_id = 0
+
+    def word_id(self, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def year_columns(self, year):
+        """Score and presence arrays of year, padded to the vocabulary size."""
+        scores = self.year_scores.get(year)
+        if scores is None:
+            scores = self.year_scores[year] = array('q')
+            self.year_presence[year] = array('B')
+        presence = self.year_presence[year]
+        if len(presence) < len(self.words):
+            padding = len(self.words) - len(presence)
+            scores.frombytes(bytes(padding * scores.itemsize))
+            presence.frombytes(bytes(padding))
+        return scores, presence
+
+    def add_document_words(self, doc_year, doc_score, doc_words):
+        if self.year_prefix_sums is not None:
+            self.drop_year_prefix_sums()
+        word_ids = [self.word_id(word) for word in doc_words]
+        scores, presence = self.year_columns(doc_year)
+        for word_id in word_ids:
+            scores[word_id] += doc_score
+            presence[word_id] = 1
+
+    def merge_statistic(self, words_statistic):
+        if self.year_prefix_sums is not None:
+            self.drop_year_prefix_sums()
+        for year, year_statistic in words_statistic.items():
+            word_scores = [(self.word_id(word), word_score) for word, word_score in year_statistic.items()]
+            scores, presence = self.year_columns(year)
+            for word_id, word_score in word_scores:
+                scores[word_id] += word_score
+                presence[word_id] = 1
+
+    def build_year_prefix_sums(self):
+        words_order = sorted(range(len(self.words)), key=self.words.__getitem__)
+        years = sorted(self.year_scores)
+        scores = array('q', bytes(8 * len(words_order)))
+        counts = array('I', bytes(4 * len(words_order)))
+        score_sums = [scores]
+        count_sums = [counts]
+        for year in years:
+            year_scores, year_presence = self.year_columns(year)
+            scores = array('q', map(operator.add, scores, map(year_scores.__getitem__, words_order)))
+            counts = array('I', map(operator.add, counts, map(year_presence.__getitem__, words_order)))
+            score_sums.append(scores)
+            count_sums.append(counts)
+        return YearPrefixSums(years, [self.words[word_id] for word_id in words_order], score_sums, count_sums)
+
+
+class SpaceSaving:
+    """Space-Saving summary of at most capacity heaviest words under positive weights.
+
+    Count of a tracked word overestimates its total weight by at most its error,
+    any untracked word weighs at most min_count.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f'sketch capacity must be positive, got {capacity}')
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    @property
+    def min_count(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        # heap keeps stale entries of incremented words, their counts differ from current ones
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def add(self, word, weight):
+        count = self.counts.get(word)
+        if count is not None:
+            self.counts[word] = count + weight
+        elif len(self.counts) < self.capacity:
+            self.counts[word] = weight
+            self.errors[word] = 0
+        else:
+            min_count = self.min_count
+            min_word = heapq.heappop(self.heap)[1]
+            del self.counts[min_word]
+            del self.errors[min_word]
+            self.counts[word] = min_count + weight
+            self.errors[word] = min_count
+        heapq.heappush(self.heap, (self.counts[word], word))
+        if len(self.heap) > SKETCH_HEAP_GROWTH * self.capacity:
+            self.heap = [(word_count, heap_word) for heap_word, word_count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+
+class ApproximateWordStatistic(WordStatistic):
+    """Word statistic in bounded memory, every year keeps Space-Saving sketches of positive and negative scores.
+
+    Answers rank words by estimated score and give bounds of their true scores.
+    """
+
+    def __init__(self, sketch_size=DEFAULT_SKETCH_SIZE, tokens_cache_size=0):
+        super().__init__(tokens_cache_size)
+        self.sketch_size = sketch_size
+        self.year_sketches = {}
+
+    def clear_statistic(self):
+        self.year_sketches.clear()
+        self.last_post_id = 0
+
+    def dump_snapshot(self, fd):
+        raise ValueError('approximate statistic can not be saved as snapshot')
+
+    def load_snapshot(self, fd):
+        raise ValueError('approximate statistic can not be loaded from snapshot')
+
+    def load_documents_parallel(self, path, encoding, workers, start=0, skip_post_id=0):
+        # workers would build exact statistics of their chunks, which breaks the memory bound
+        raise ValueError('approximate statistic is built by single process')
+
+    def add_words_score(self, year, words, score):
+        sketches = self.year_sketches.get(year)
+        if sketches is None:
+            sketches = self.year_sketches[year] = (SpaceSaving(self.sketch_size), SpaceSaving(self.sketch_size))
+        # zero score goes to positive sketch to record presence of words
+        sketch = sketches[0] if score >= 0 else sketches[1]
+        for word in words:
+            sketch.add(word, abs(score))
+
+    def add_document_words(self, doc_year, doc_score, doc_words):
+        self.add_words_score(doc_year, doc_words, doc_score)
+
+    def merge_statistic(self, words_statistic):
+        for year, year_statistic in words_statistic.items():
+            if not year_statistic:
+                self.add_words_score(year, (), 0)
+            for word, word_score in year_statistic.items():
+                self.add_words_score(year, (word,), word_score)
+
+    def top_words(self, start_year, end_year, top_n):
+        """Words count, top words with estimated scores and [lower, upper] bounds of their scores."""
+        sketches = [(sketch, sign, sketch.min_count)
+                    for year, year_sketches in self.year_sketches.items() if start_year <= year <= end_year
+                    for sketch, sign in zip(year_sketches, (1, -1))]
+        words_estimates = {}
+        for word in set().union(*(sketch.counts for sketch, _, _ in sketches)):
+            estimate = lower = upper = 0
+            for sketch, sign, min_count in sketches:
+                count = sketch.counts.get(word)
+                if count is None:
+                    word_lower, word_upper = 0, min_count
+                else:
+                    estimate += sign * count
+                    word_lower, word_upper = count - sketch.errors[word], count
+                if sign > 0:
+                    lower, upper = lower + word_lower, upper + word_upper
+                else:
+                    lower, upper = lower - word_upper, upper - word_lower
+            words_estimates[word] = (estimate, lower, upper)
+        top_n_words = heapq.nsmallest(top_n, words_estimates, key=lambda word: (-words_estimates[word][0], word))
+        return (len(words_estimates), [(word, words_estimates[word][0]) for word in top_n_words],
+                [list(words_estimates[word][1:]) for word in top_n_words])
+
+    def calculate_statistic(self, start_year, end_year, top_n):
+        logger.debug('got query "%d,%d,%d"' % (start_year, end_year, top_n))
+        return self.format_answer(start_year, end_year, top_n, *self.top_words(start_year, end_year, top_n))
+
+    def calculate_statistics(self, queries):
+        return [self.calculate_statistic(start_year, end_year, top_n) for start_year, end_year, top_n in queries]
+
+
 def setup_parser(arg_parser):
     if len(sys.argv) == 1:
         arg_parser.print_help()
@@ -88,10 +806,9 @@ def setup_parser(arg_parser):
 
     arg_parser.add_argument(
         '--questions',
-        help='path to questions dataset file',
+        help='path to questions dataset file, gzip, bz2 and zstd compressed files are decompressed on the fly',
         metavar='QUESTIONS_DATASET_FILEPATH',
-        type=FileType('r', encoding='utf-8'),
-        required=True
+        type=questions_file,
     )
 
     arg_parser.add_argument(
@@ -99,7 +816,6 @@ def setup_parser(arg_parser):
         help='path to stop words file in koi8-r encoding',
         metavar='STOP_WORDS_FILEPATH',
         type=FileType('r', encoding='koi8-r'),
-        required=True
     )
 
     arg_parser.add_argument(
@@ -107,7 +823,61 @@ def setup_parser(arg_parser):
         help='path to queries file',
         metavar='QUERIES_FILEPATH',
         type=FileType('r'),
-        required=True
+    )
+
+    arg_parser.add_argument(
+        '--workers',
+        help='number of processes parsing line-aligned chunks of questions dataset',
+        metavar='WORKERS',
+        type=int,
+        default=1
+    )
+
+    arg_parser.add_argument(
+        '--compact',
+        help='keep word statistic in per year arrays over interned words instead of dicts',
+        action='store_true',
+    )
+
+    arg_parser.add_argument(
+        '--approximate',
+        help='keep bounded Space-Saving sketches of word scores and answer with bounds of true scores',
+        action='store_true',
+    )
+
+    arg_parser.add_argument(
+        '--sketch-size',
+        help='number of words tracked by every sketch of --approximate statistic',
+        metavar='SKETCH_SIZE',
+        type=int,
+        default=DEFAULT_SKETCH_SIZE
+    )
+
+    arg_parser.add_argument(
+        '--tokens-cache-size',
+        help='number of recent titles whose words are cached, repeated titles are not tokenized again',
+        metavar='TOKENS_CACHE_SIZE',
+        type=int,
+        default=0
+    )
+
+    arg_parser.add_argument(
+        '--ingest',
+        help='add only questions with Id greater than the last one added to --load-snapshot statistic',
+        action='store_true',
+    )
+
+    arg_parser.add_argument(
+        '--dump-snapshot',
+        help='path for saving word statistic snapshot, queries of unchanged dataset can be served from it',
+        metavar='SNAPSHOT_FILEPATH',
+    )
+
+    arg_parser.add_argument(
+        '--load-snapshot',
+        help='path to word statistic snapshot used instead of or in addition to questions dataset',
+        metavar='SNAPSHOT_FILEPATH',
+        type=FileType('rb'),
     )
 
 
@@ -124,16 +894,45 @@ if __name__ == '__main__':
     )
     setup_parser(parser)
     arguments = parser.parse_args()
+    if arguments.questions is None and arguments.load_snapshot is None:
+        parser.error('one of the arguments --questions --load-snapshot is required')
+    if arguments.questions is not None and arguments.stop_words is None:
+        parser.error('the argument --stop-words is required with --questions')
+    if arguments.approximate and arguments.workers > 1:
+        parser.error('the argument --approximate is not allowed with --workers greater than 1')
+    if arguments.approximate:
+        # sketches can not be saved as snapshot and have their own bounded memory layout
+        for option, value in (('--dump-snapshot', arguments.dump_snapshot),
+                              ('--load-snapshot', arguments.load_snapshot),
+                              ('--ingest', arguments.ingest),
+                              ('--compact', arguments.compact)):
+            if value:
+                parser.error(f'the argument --approximate is not allowed with {option}')
+    if arguments.ingest and (arguments.questions is None or arguments.load_snapshot is None):
+        parser.error('the argument --ingest requires --questions and --load-snapshot')
 
-    statistic = WordStatistic()
-    statistic.load_stop_words(arguments.stop_words)
-    documents = statistic.parse_documents(arguments.questions)
-    for year, score, words in documents:
-        statistic.add_new_document_to_statistic(year, score, words)
-    logger.info('process XML dataset, ready to serve queries')
-
-    answers = []
-    for q_start_year, q_end_year, q_top_n in statistic.parse_queries(arguments.queries):
-        answers.append(statistic.calculate_statistic(q_start_year, q_end_year, q_top_n))
-    print(*answers, sep='\n')
-    logger.info('finish processing queries')
+    if arguments.approximate:
+        statistic = ApproximateWordStatistic(arguments.sketch_size, arguments.tokens_cache_size)
+    else:
+        statistic_class = CompactWordStatistic if arguments.compact else WordStatistic
+        statistic = statistic_class(arguments.tokens_cache_size)
+    if arguments.load_snapshot is not None:
+        statistic.load_snapshot(arguments.load_snapshot)
+        logger.info('load word statistic snapshot')
+        if arguments.ingest and not statistic.last_post_id:
+            parser.error('snapshot has no last post Id to ingest after, rebuild it from the whole questions dataset')
+    if arguments.questions is not None:
+        statistic.load_stop_words(arguments.stop_words)
+        last_post_id = statistic.last_post_id
+        documents_count = statistic.load_documents(arguments.questions, arguments.workers, arguments.ingest)
+        if arguments.ingest:
+            logger.info('ingest %d questions after post %d' % (documents_count, last_post_id))
+        logger.info('process XML dataset with %d questions, ready to serve queries' % documents_count)
+    if arguments.dump_snapshot is not None:
+        statistic.save_snapshot(arguments.dump_snapshot)
+        logger.info('save word statistic snapshot')
+
+    if arguments.queries is not None:
+        answers = statistic.calculate_statistics(statistic.parse_queries(arguments.queries))
+        print(*answers, sep='\n')
+        logger.info('finish processing queries')
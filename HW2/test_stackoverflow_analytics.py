@@ -1,9 +1,20 @@
 from argparse import ArgumentParser
+import re
+import bz2
+import struct
+import gzip
+import json
+import random
+from io import BytesIO
+from itertools import cycle
+from collections import defaultdict
 
 import pytest
 from unittest.mock import patch
 
-from stackoverflow_analytics import WordStatistic, setup_parser
+from stackoverflow_analytics import WordStatistic, CompactWordStatistic, ApproximateWordStatistic, SpaceSaving, \
+    setup_parser, split_file_chunks, select_top_words, open_questions, find_new_posts_offset, \
+    SNAPSHOT_MAGIC, SNAPSHOT_HEADER_FORMATS
 
 NOT_EXIST_FILEPATH = 'not_exist_filepath'
 
@@ -62,6 +73,156 @@ def test_parse_documents_validation(data, expected_len):
     assert expected_len == cur_len
 
 
+def test_iter_documents_streams_rows():
+    rows = cycle(['<row PostTypeId="2" CreationDate="2010-11-15T20:09:58.970" Score="1" />',
+                  '<row PostTypeId="1" CreationDate="2010-11-15T20:09:58.970" Score="1" Title="SQL Server" />'])
+    documents = WordStatistic.iter_documents(rows)
+    assert (2010, 1, 'SQL Server') == next(documents)
+    assert (2010, 1, 'SQL Server') == next(documents)
+
+
+def test_iter_posts_keeps_questions_without_integer_id():
+    rows = ['<row Id="7" PostTypeId="1" CreationDate="2010-11-15T20:09:58.970" Score="1" Title="SQL Server" />',
+            '<row Id="x8" PostTypeId="1" CreationDate="2011-11-15T20:09:58.970" Score="2" Title="Python" />',
+            '<row PostTypeId="1" CreationDate="2012-11-15T20:09:58.970" Score="3" Title="Java" />']
+    assert [(7, 2010, 1, 'SQL Server'), (0, 2011, 2, 'Python'), (0, 2012, 3, 'Java')] == list(
+        WordStatistic.iter_posts(rows))
+
+
+def test_load_documents():
+    rows = ['<?xml version="1.0" encoding="utf-8"?>', '<posts>',
+            '<row PostTypeId="1" CreationDate="2019-11-15T20:09:58.970" Score="10" Title="SEO better" />',
+            '<row PostTypeId="1" CreationDate="2020-11-15T20:09:58.970" Score="5" Title="SEO &amp; Python" />',
+            '</posts>']
+    statistic = WordStatistic()
+    assert 2 == statistic.load_documents(rows)
+    assert {2019: {'seo': 10, 'better': 10}, 2020: {'seo': 5, 'python': 5}} == statistic.words_statistic
+
+
+def write_posts(path, posts_count, post_id=False, post_type=None, compress=None):
+    """Write generated rows, every third one is an answer unless post_type is given.
+
+    With post_id rows are numbered from 1 by Id and wrapped into posts element,
+    compress is applied to encoded file data.
+    """
+    rows = ['<?xml version="1.0" encoding="utf-8"?>', '<posts>'] if post_id else []
+    for doc_ind in range(1, posts_count + 1) if post_id else range(posts_count):
+        id_attribute = f'Id="{doc_ind}" ' if post_id else ''
+        rows.append(f'<row {id_attribute}PostTypeId="{post_type or doc_ind % 3 % 2 + 1}" '
+                    f'CreationDate="{2008 + doc_ind % 4}-11-15T20:09:58.970" Score="{doc_ind % 7 - 2}" '
+                    f'Title="Word{doc_ind % 5} is word {doc_ind % 11} и слово" />')
+    if post_id:
+        rows.append('</posts>')
+    data = ('\n'.join(rows) + '\n').encode('utf-8')
+    path.write_bytes(compress(data) if compress is not None else data)
+
+
+@pytest.mark.parametrize('workers', [2, 3, 10])
+def test_load_documents_parallel_same_as_single_process(tmp_path, workers):
+    questions_path = tmp_path / 'questions.xml'
+    write_posts(questions_path, 100)
+    statistics = []
+    for workers_count in (1, workers):
+        statistic = WordStatistic()
+        statistic.load_stop_words(['is'])
+        with open(questions_path, encoding='utf-8') as fd:
+            assert 67 == statistic.load_documents(fd, workers_count)
+        statistics.append(statistic.words_statistic)
+    assert statistics[0] == statistics[1], 'parallel statistic differs from single process statistic'
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, bz2.compress])
+def test_load_compressed_documents_same_as_plain(tmp_path, compress):
+    write_posts(tmp_path / 'questions.xml', 3000, post_type=1)
+    write_posts(tmp_path / 'questions.xml.compressed', 3000, post_type=1, compress=compress)
+    statistics = []
+    for path in (tmp_path / 'questions.xml', tmp_path / 'questions.xml.compressed'):
+        statistic = WordStatistic()
+        with open_questions(path) as fd:
+            assert 3000 == statistic.load_documents(fd, workers=2)
+        statistics.append(statistic.words_statistic)
+    assert statistics[0] == statistics[1]
+
+
+def test_load_zstd_compressed_documents(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    write_posts(tmp_path / 'questions.xml', 3000, post_type=1)
+    write_posts(tmp_path / 'questions.xml.zst', 3000, post_type=1, compress=zstandard.ZstdCompressor().compress)
+    with open_questions(tmp_path / 'questions.xml') as plain_fd, \
+            open_questions(tmp_path / 'questions.xml.zst') as fd:
+        assert plain_fd.read() == fd.read()
+
+
+def test_open_zstd_without_zstandard(tmp_path):
+    write_posts(tmp_path / 'questions.xml.zst', 3000, post_type=1, compress=lambda data: b'\x28\xb5\x2f\xfd' + data)
+    with patch('stackoverflow_analytics.zstandard', None):
+        with pytest.raises(ImportError):
+            open_questions(tmp_path / 'questions.xml.zst')
+
+
+def test_load_truncated_compressed_documents(tmp_path):
+    write_posts(tmp_path / 'questions.xml.gz', 3000, post_type=1, compress=lambda data: gzip.compress(data)[:-100])
+    with open_questions(tmp_path / 'questions.xml.gz') as fd:
+        with pytest.raises(EOFError):
+            WordStatistic().load_documents(fd)
+
+
+@pytest.mark.parametrize('last_post_id', [0, 1, 2, 57, 99, 100, 150])
+def test_find_new_posts_offset(tmp_path, last_post_id):
+    path = tmp_path / 'posts.xml'
+    write_posts(path, 100, post_id=True)
+    offset = find_new_posts_offset(path, last_post_id)
+    lines = path.read_bytes().splitlines(keepends=True)
+    line_ind = min([line_ind for line_ind, line in enumerate(lines) if b' Id="' in line
+                    and int(line.split(b'"')[1]) > last_post_id] or [len(lines)])
+    assert sum(map(len, lines[:line_ind])) == offset
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_ingest_new_posts_same_as_full_load(tmp_path, workers):
+    old_path, path = tmp_path / 'old_posts.xml', tmp_path / 'posts.xml'
+    write_posts(old_path, 60, post_id=True)
+    write_posts(path, 100, post_id=True)
+    statistic = WordStatistic()
+    with open_questions(old_path) as fd:
+        statistic.load_documents(fd)
+    assert 60 == statistic.last_post_id
+    snapshot = BytesIO()
+    statistic.dump_snapshot(snapshot)
+
+    ingested_statistic = WordStatistic()
+    ingested_statistic.load_snapshot(BytesIO(snapshot.getvalue()))
+    with open_questions(path) as fd:
+        assert 26 == ingested_statistic.load_documents(fd, workers, ingest=True)
+    assert 99 == ingested_statistic.last_post_id
+    full_statistic = WordStatistic()
+    with open_questions(path) as fd:
+        full_statistic.load_documents(fd)
+    assert full_statistic.words_statistic == ingested_statistic.words_statistic
+
+
+def test_ingest_without_last_post_id():
+    rows = ['<row PostTypeId="1" CreationDate="2019-11-15T20:09:58.970" Score="1" Title="alpha" />'] * 5
+    statistic = WordStatistic()
+    statistic.load_documents(rows)
+    snapshot = BytesIO()
+    statistic.dump_snapshot(snapshot)
+    statistic.load_snapshot(BytesIO(snapshot.getvalue()))
+    with pytest.raises(ValueError):
+        statistic.load_documents(rows * 2, ingest=True)
+    assert {2019: {'alpha': 5}} == dict(statistic.get_year_prefix_sums().iter_years_statistic())
+
+
+@pytest.mark.parametrize('chunks_count', [1, 2, 5])
+def test_split_file_chunks(tmp_path, chunks_count):
+    path = tmp_path / 'lines.txt'
+    path.write_bytes(b'first line\nsecond\n\nthird line\nlast')
+    chunks = split_file_chunks(path, chunks_count)
+    data = path.read_bytes()
+    assert data == b''.join(data[start:end] for start, end in chunks)
+    assert all(data[end - 1:end] == b'\n' for _, end in chunks[:-1])
+
+
 @pytest.mark.parametrize('doc_info, expected_year_len, expected_words_len', [
     ([(1999, -2, 'word $word are'),
       (1999, -2, 'another word,word')], 1, 3),
@@ -108,6 +269,31 @@ def test_add_new_document_with_stop_words(doc_info, stop_words, expected_words_l
     assert expected_words_len == words_count
 
 
+@pytest.mark.parametrize('tokens_cache_size', [0, 2])
+def test_documents_words_same_as_document_words(tokens_cache_size):
+    doc_texts = ['Is SEO better?', 'What is SEO?', 'Is SEO better?', 'word,Word_2 $wOrd', '', 'Is SEO better?']
+    statistic = WordStatistic(tokens_cache_size)
+    statistic.load_stop_words(['is', 'what'])
+    expected_words = [{word for word in set(re.findall(r'\w+', doc_text.lower())) if word not in {'is', 'what'}}
+                      for doc_text in doc_texts]
+    assert expected_words == [set(statistic.document_words(doc_text)) for doc_text in doc_texts]
+    assert expected_words == list(map(set, statistic.documents_words(doc_texts)))
+
+
+@pytest.mark.parametrize('statistic_class', [WordStatistic, CompactWordStatistic])
+def test_add_new_documents_same_as_add_new_document(statistic_class):
+    documents = [(2008 + doc_ind % 3, doc_ind % 7 - 3, f'word{doc_ind % 5} Word{doc_ind % 11} is')
+                 for doc_ind in range(50)]
+    statistic = statistic_class()
+    batch_statistic = statistic_class(tokens_cache_size=8)
+    for current_statistic in (statistic, batch_statistic):
+        current_statistic.load_stop_words(['is'])
+    for doc_year, doc_score, doc_text in documents:
+        statistic.add_new_document_to_statistic(doc_year, doc_score, doc_text)
+    batch_statistic.add_new_documents_to_statistic(documents)
+    assert statistic.calculate_statistic(2008, 2010, 20) == batch_statistic.calculate_statistic(2008, 2010, 20)
+
+
 @pytest.mark.parametrize('queries, expected_queries_len', [
     (['1999,2000,3', '1999,2000,3', '1999,2000,3'], 3),
     (['1999,2000,text', '2000,3', '1999,,3'], 0),
@@ -137,3 +323,195 @@ def test_calculate_statistic(start_year, end_year, top_n, expected_answer):
         statistic.add_new_document_to_statistic(doc_year, doc_score, doc_text)
     answer = statistic.calculate_statistic(start_year, end_year, top_n)
     assert expected_answer == answer
+
+
+def calculate_statistic_by_merge(words_statistic, start_year, end_year, top_n):
+    years_statistic = defaultdict(int)
+    for stat_year in range(start_year, end_year + 1):
+        for word, word_score in words_statistic.get(stat_year, {}).items():
+            years_statistic[word] += word_score
+    return sorted(years_statistic.items(), key=lambda x: (-x[1], x[0]))[:top_n]
+
+
+def test_calculate_statistic_same_as_merge_of_years():
+    rnd = random.Random(0)
+    statistic = WordStatistic()
+    for _ in range(300):
+        statistic.add_new_document_to_statistic(rnd.randint(2008, 2014), rnd.randint(-5, 5),
+                                                ' '.join(rnd.choices('abcdefghijklmnopqrstuvwxyz', k=5)))
+    for start_year, end_year, top_n in [(2008, 2014, 10), (2010, 2010, 3), (2000, 2009, 30), (2013, 2020, 5),
+                                        (2011, 2010, 5), (1990, 2000, 5), (2008, 2014, 100)]:
+        expected = calculate_statistic_by_merge(statistic.words_statistic, start_year, end_year, top_n)
+        answer = json.loads(statistic.calculate_statistic(start_year, end_year, top_n))
+        assert [list(item) for item in expected] == answer['top'], f'wrong top of {start_year},{end_year}'
+
+
+def test_calculate_statistic_after_new_documents():
+    statistic = WordStatistic()
+    statistic.add_new_document_to_statistic(2019, 10, 'seo')
+    assert '{"start": 2019, "end": 2019, "top": [["seo", 10]]}' == statistic.calculate_statistic(2019, 2019, 2)
+    statistic.add_new_document_to_statistic(2019, 20, 'python')
+    assert ('{"start": 2019, "end": 2019, "top": [["python", 20], ["seo", 10]]}'
+            == statistic.calculate_statistic(2019, 2019, 2)), 'statistic was not updated with new documents'
+
+
+@pytest.mark.parametrize('top_n', [0, 1, 3, 5, 20, -2])
+def test_select_top_words_same_as_sort(top_n):
+    scores = [5, -1, 3, 5, 0, 3, 3, 7, 0, 5, -1, 2]
+    word_ids = [0, 2, 3, 4, 5, 6, 7, 8, 9, 11]
+    expected = sorted(word_ids, key=lambda word_id: (-scores[word_id], word_id))[:top_n]
+    assert expected == select_top_words(scores, word_ids, top_n)
+
+
+def test_calculate_statistics_same_as_calculate_statistic():
+    rnd = random.Random(1)
+    statistic = WordStatistic()
+    for _ in range(100):
+        statistic.add_new_document_to_statistic(rnd.randint(2008, 2012), rnd.randint(-5, 5),
+                                                ' '.join(rnd.choices('abcdefghij', k=3)))
+    queries = [(2008, 2012, 3), (2009, 2010, 5), (2008, 2012, 1), (2008, 2012, 30), (2009, 2010, 2),
+               (2009, 2010, -1), (2020, 2021, 2)]
+    expected = [statistic.calculate_statistic(*query) for query in queries]
+    assert expected == statistic.calculate_statistics(queries), 'batch answers differ from calculate_statistic'
+
+
+def build_random_statistic(seed, documents_count, statistic_class=WordStatistic):
+    rnd = random.Random(seed)
+    statistic = statistic_class()
+    for _ in range(documents_count):
+        statistic.add_new_document_to_statistic(rnd.randint(2008, 2012), rnd.randint(-5, 5),
+                                                ' '.join(rnd.choices(['a', 'b', 'c', 'd', 'слово', 'e'], k=3)))
+    return statistic
+
+
+@pytest.mark.parametrize('statistic_class', [WordStatistic, CompactWordStatistic])
+def test_dump_load_snapshot(tmp_path, statistic_class):
+    statistic = build_random_statistic(2, 50)
+    snapshot_path = tmp_path / 'statistic.snapshot'
+    with open(snapshot_path, 'wb') as fd:
+        statistic.dump_snapshot(fd)
+    queries = [(2008, 2012, 10), (2009, 2010, 2), (2000, 2008, 3), (2013, 2014, 1)]
+
+    loaded_statistic = statistic_class()
+    with open(snapshot_path, 'rb') as fd:
+        loaded_statistic.load_snapshot(fd)
+    assert statistic.calculate_statistics(queries) == loaded_statistic.calculate_statistics(queries), (
+        'loaded snapshot answers differ')
+
+    statistic.add_new_document_to_statistic(2010, 7, 'слово f')
+    loaded_statistic.add_new_document_to_statistic(2010, 7, 'слово f')
+    assert statistic.words_statistic == loaded_statistic.words_statistic, 'snapshot statistic was not restored'
+    assert statistic.calculate_statistics(queries) == loaded_statistic.calculate_statistics(queries), (
+        'answers differ after new document added to loaded snapshot')
+
+
+def test_save_snapshot_over_loaded_snapshot(tmp_path):
+    snapshot_path = str(tmp_path / 'statistic.snapshot')
+    build_random_statistic(4, 30).save_snapshot(snapshot_path)
+    statistic = WordStatistic()
+    with open(snapshot_path, 'rb') as fd:
+        statistic.load_snapshot(fd)
+        statistic.add_new_document_to_statistic(2010, 7, 'слово f')
+        statistic.save_snapshot(snapshot_path)
+    refreshed_statistic = WordStatistic()
+    with open(snapshot_path, 'rb') as fd:
+        refreshed_statistic.load_snapshot(fd)
+    assert statistic.calculate_statistic(2000, 2020, 10) == refreshed_statistic.calculate_statistic(2000, 2020, 10)
+    assert [] == [path for path in tmp_path.iterdir() if path.suffix == '.tmp']
+
+
+def test_load_version_1_snapshot():
+    statistic = build_random_statistic(3, 30)
+    statistic.last_post_id = 42
+    snapshot = BytesIO()
+    statistic.dump_snapshot(snapshot)
+    snapshot_v2 = snapshot.getvalue()
+    _, _, byte_order, years_count, vocabulary_size, _ = struct.unpack_from(SNAPSHOT_HEADER_FORMATS[2], snapshot_v2)
+    snapshot_v1 = struct.pack(SNAPSHOT_HEADER_FORMATS[1], SNAPSHOT_MAGIC, 1, byte_order, years_count,
+                              vocabulary_size) + snapshot_v2[struct.calcsize(SNAPSHOT_HEADER_FORMATS[2]):]
+    loaded_statistics = []
+    for snapshot_bytes in (snapshot_v1, snapshot_v2):
+        loaded_statistic = WordStatistic()
+        loaded_statistic.load_snapshot(BytesIO(snapshot_bytes))
+        loaded_statistics.append(loaded_statistic)
+    assert [0, 42] == [loaded_statistic.last_post_id for loaded_statistic in loaded_statistics]
+    assert loaded_statistics[0].calculate_statistic(2000, 2020, 10) == statistic.calculate_statistic(2000, 2020, 10)
+
+
+def test_load_not_snapshot():
+    with pytest.raises(ValueError):
+        WordStatistic().load_snapshot(BytesIO(b'<row PostTypeId="1" />' + bytes(32)))
+
+
+def test_compact_statistic_same_as_dict_statistic():
+    statistic = build_random_statistic(3, 80)
+    compact_statistic = build_random_statistic(3, 80, CompactWordStatistic)
+    assert statistic.words_statistic == compact_statistic.words_statistic, 'compact statistic has other scores'
+    queries = [(2008, 2012, 10), (2009, 2010, 2), (2011, 2011, 1), (2013, 2014, 1)]
+    assert statistic.calculate_statistics(queries) == compact_statistic.calculate_statistics(queries), (
+        'compact statistic answers differ')
+
+    statistic.merge_statistic({2010: {'new': 3, 'a': -1}, 2015: {}})
+    compact_statistic.merge_statistic({2010: {'new': 3, 'a': -1}, 2015: {}})
+    assert statistic.words_statistic == compact_statistic.words_statistic, 'wrong merge into compact statistic'
+    assert statistic.calculate_statistics(queries) == compact_statistic.calculate_statistics(queries), (
+        'compact statistic answers differ after merge')
+
+
+def test_space_saving_keeps_heavy_words():
+    sketch = SpaceSaving(3)
+    for word, weight in [('a', 10), ('b', 1), ('c', 2), ('d', 1), ('a', 5), ('e', 1), ('f', 20)]:
+        sketch.add(word, weight)
+    assert 3 == len(sketch.counts)
+    assert 15 == sketch.counts['a'] and 0 == sketch.errors['a'], 'heavy word was evicted'
+    assert 'f' in sketch.counts and sketch.counts['f'] - sketch.errors['f'] <= 20 <= sketch.counts['f']
+
+
+def test_approximate_statistic_exact_with_large_sketches():
+    statistic = build_random_statistic(4, 80)
+    approximate_statistic = build_random_statistic(4, 80, ApproximateWordStatistic)
+    for start_year, end_year, top_n in [(2008, 2012, 3), (2009, 2010, 2), (2013, 2014, 1)]:
+        expected = json.loads(statistic.calculate_statistic(start_year, end_year, top_n))
+        answer = json.loads(approximate_statistic.calculate_statistic(start_year, end_year, top_n))
+        assert expected['top'] == answer['top'], 'approximate statistic is not exact with large sketches'
+        assert [[score, score] for _, score in expected['top']] == answer['bounds'], 'wrong bounds of exact scores'
+
+
+def test_approximate_statistic_keeps_zero_and_negative_scores():
+    doc_info = [(2019, -3, 'alpha'), (2019, 0, 'beta'), (2019, 2, 'gamma')]
+    statistic = WordStatistic()
+    approximate_statistic = ApproximateWordStatistic(sketch_size=100)
+    for doc_year, doc_score, doc_text in doc_info:
+        statistic.add_new_document_to_statistic(doc_year, doc_score, doc_text)
+        approximate_statistic.add_new_document_to_statistic(doc_year, doc_score, doc_text)
+    expected = json.loads(statistic.calculate_statistic(2019, 2019, 5))
+    answer = json.loads(approximate_statistic.calculate_statistic(2019, 2019, 5))
+    assert [['gamma', 2], ['beta', 0], ['alpha', -3]] == expected['top'] == answer['top']
+    assert [[2, 2], [0, 0], [-3, -3]] == answer['bounds']
+
+
+def test_approximate_statistic_rejects_parallel_load(tmp_path):
+    write_posts(tmp_path / 'questions.xml', 3000, post_type=1)
+    with open_questions(tmp_path / 'questions.xml') as fd:
+        with pytest.raises(ValueError):
+            ApproximateWordStatistic().load_documents(fd, workers=2)
+
+
+def test_approximate_statistic_bounds_true_scores():
+    rnd = random.Random(5)
+    words = [f'w{word_ind}' for word_ind in range(60)]
+    statistic = WordStatistic()
+    approximate_statistic = ApproximateWordStatistic(sketch_size=8)
+    for _ in range(500):
+        doc_args = (rnd.randint(2008, 2010), rnd.choice([-3, -1, 0, 2, 5, 20]),
+                    ' '.join(rnd.choices(words, weights=range(60, 0, -1), k=4)))
+        statistic.add_new_document_to_statistic(*doc_args)
+        approximate_statistic.add_new_document_to_statistic(*doc_args)
+    true_scores = defaultdict(int)
+    for year_statistic in statistic.words_statistic.values():
+        for word, word_score in year_statistic.items():
+            true_scores[word] += word_score
+    answer = json.loads(approximate_statistic.calculate_statistic(2008, 2010, 5))
+    assert 5 == len(answer['top'])
+    for (word, _), (lower, upper) in zip(answer['top'], answer['bounds']):
+        assert lower <= true_scores[word] <= upper, f'true score of {word} is out of bounds'